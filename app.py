@@ -1,8 +1,9 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime, timedelta
-from PIL import Image
+from datetime import datetime, timedelta, timezone
+from PIL import Image, ImageOps
 import io
 import base64
 import re
@@ -12,6 +13,23 @@ import os
 from supabase import create_client, Client
 import secrets as python_secrets
 import uuid
+import functools
+import sqlite3
+import threading
+import queue
+import atexit
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+import random
+import logging
+import contextvars
+import contextlib
+import socket
+import gzip
+import conversation_io
+import compaction
+import memory_index
 
 # Configuration de la page
 st.set_page_config(
@@ -24,6 +42,152 @@ st.set_page_config(
 SUPABASE_URL = os.getenv("SUPABASE_URL") or st.secrets.get("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") or st.secrets.get("SUPABASE_KEY", "")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY") or st.secrets.get("GROQ_API_KEY", "")
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+
+# Client HTTP Groq : pool de connexions keep-alive et reprises sur erreurs transitoires
+GROQ_POOL_SIZE = int(os.getenv("GROQ_POOL_SIZE", "20"))
+GROQ_CONNECT_TIMEOUT = 5
+GROQ_READ_TIMEOUT = 60
+GROQ_MAX_RETRIES = 3
+GROQ_BACKOFF_BASE = 0.5
+GROQ_BACKOFF_MAX = 8
+# Au-delà de cette attente imposée par Groq, on abandonne plutôt que de bloquer l'utilisateur
+GROQ_MAX_RETRY_WAIT = 20
+
+# Cache des réponses : mémoire (LRU) + disque (SQLite avec TTL et taille maximale)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".frejus_cache/responses.sqlite3")
+RESPONSE_CACHE_MEMORY_ENTRIES = 256
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# Seules les réponses peu aléatoires sont mises en cache (par défaut : mode codage)
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.3"))
+
+# Écriture différée des messages (insertions groupées par un thread dédié)
+WRITE_MAX_ATTEMPTS = 8
+WRITE_BACKOFF_BASE = 0.5
+WRITE_BACKOFF_MAX = 30
+
+# Cache des sessions validées et nettoyage des sessions expirées
+SESSION_CACHE_TTL = 300
+SESSION_CACHE_MAX_ENTRIES = 10000
+SESSION_SWEEP_INTERVAL = 3600
+
+# Nombre de messages affichés (et chargés par page) dans le chat
+CHAT_WINDOW_SIZE = 50
+
+# Images jointes : décodées, réduites et recompressées avant l'envoi au modèle vision
+ATTACHMENT_TYPES = ["png", "jpg", "jpeg", "webp", "gif"]
+ATTACHMENT_MAX_FILES = 3
+ATTACHMENT_MAX_UPLOAD_BYTES = 25 * 1024 * 1024  # aussi server.maxUploadSize (.streamlit/config.toml)
+ATTACHMENT_MAX_PIXELS = 60_000_000  # garde-fou contre les "bombes de décompression"
+ATTACHMENT_MAX_SIDE = 1024
+ATTACHMENT_MAX_BYTES = 400 * 1024  # JPEG envoyé, avant base64
+ATTACHMENT_JPEG_QUALITY = 85
+THUMBNAIL_SIDE = 256
+THUMBNAIL_CACHE_ENTRIES = 512
+
+# Colonnes facultatives de messages, retirées si la migration n'est pas appliquée
+OPTIONAL_MESSAGE_COLUMNS = ("model", "attachments")
+
+# Liste des conversations : relue depuis Supabase au plus toutes les N secondes
+# (modifications faites depuis un autre appareil), sinon tenue à jour localement
+CONVERSATION_RESYNC_INTERVAL = 300
+
+# Lectures Supabase indépendantes d'un rerun, lancées en parallèle (pool partagé par le processus)
+PAGE_LOAD_WORKERS = int(os.getenv("PAGE_LOAD_WORKERS", "16"))
+# Tâches de fond lentes (résumés Groq...) : pool séparé, elles ne retardent pas les lectures de page
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+
+# Recherche plein texte dans les conversations
+SEARCH_MIN_LENGTH = 2
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_SNIPPET_CHARS = 160
+
+# Routage automatique entre les modèles Groq
+AUTO_MODEL = "auto"
+# A priori (temps jusqu'au premier token en s, tokens/s) avant les premières mesures
+ROUTER_PRIORS = {
+    "llama-3.1-8b-instant": (0.25, 700),
+    "gemma2-9b-it": (0.3, 600),
+    "mixtral-8x7b-32768": (0.35, 450),
+    "llama-3.3-70b-versatile": (0.45, 275)
+}
+# Petits modèles réservés aux questions courtes en conversation générale
+ROUTER_SMALL_MODELS = {"llama-3.1-8b-instant", "gemma2-9b-it"}
+ROUTER_SHORT_PROMPT_TOKENS = 150
+ROUTER_EWMA_ALPHA = 0.2
+ROUTER_MAX_COOLDOWN = 120
+
+# Requêtes de secours (hedging) : si le premier token tarde au-delà du percentile
+# observé du TTFT, une seconde requête est lancée et la plus rapide est gardée
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 2.0  # tant qu'il y a moins de HEDGE_MIN_SAMPLES mesures
+HEDGE_MIN_DELAY = 0.3
+HEDGE_MAX_DELAY = 10
+# Part maximale de requêtes doublées, sur les HEDGE_RATE_WINDOW dernières (protège le quota)
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+HEDGE_RATE_WINDOW = 100
+
+# Admission des requêtes Groq (clé partagée par tous les utilisateurs) : seau de
+# tokens estimés (prompt + réponse maximale) par utilisateur, nombre maximal de
+# requêtes simultanées pour le processus, file servie équitablement entre utilisateurs
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+ADMISSION_BUCKET_TOKENS = int(os.getenv("ADMISSION_BUCKET_TOKENS", "24000"))
+ADMISSION_REFILL_PER_SECOND = float(os.getenv("ADMISSION_REFILL_PER_SECOND", "200"))
+ADMISSION_MAX_WAIT = 90
+ADMISSION_POLL_INTERVAL = 0.5
+ADMISSION_IMAGE_TOKENS = 1500  # coût forfaitaire d'une image jointe
+
+# Traçage des appels Supabase / Groq (panneau de debug réservé aux administrateurs)
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() in ("1", "true", "yes")
+try:
+    admin_users_setting = os.getenv("ADMIN_USERS") or st.secrets.get("ADMIN_USERS", "")
+except FileNotFoundError:
+    # Pas de secrets.toml : configuration par variables d'environnement uniquement
+    admin_users_setting = ""
+ADMIN_USERS = {name.strip() for name in admin_users_setting.split(",") if name.strip()}
+TRACE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Intervalle minimal (secondes) entre deux rafraîchissements pendant le streaming
+STREAM_RENDER_INTERVAL = 0.05
+
+# Modèle utilisé dès qu'un message contient des images
+VISION_MODEL = os.getenv("VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+
+# Fenêtre de contexte (tokens) de chaque modèle proposé dans la sidebar
+MODEL_CONTEXT_LIMITS = {
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-8b-instant": 131072,
+    "mixtral-8x7b-32768": 32768,
+    "gemma2-9b-it": 8192,
+    VISION_MODEL: 131072
+}
+DEFAULT_CONTEXT_LIMIT = 8192
+# Budget maximal du prompt, même pour les grands modèles (limite le coût du prefill)
+CONTEXT_PROMPT_BUDGET = int(os.getenv("CONTEXT_PROMPT_BUDGET", "8000"))
+# Modèle rapide utilisé pour résumer les anciens échanges
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+SUMMARY_MAX_TOKENS = 600
+# Pages d'historique lues au plus pour compléter le résumé (l'historique plus ancien n'est pas résumé)
+SUMMARY_MAX_LOAD_PAGES = 4
+# Attente avant de relancer un résumé échoué, doublée à chaque échec consécutif
+SUMMARY_RETRY_DELAY = 60
+SUMMARY_RETRY_MAX_DELAY = 3600
+
+# Mémoire entre conversations (option de la sidebar) : au lieu de l'historique
+# complet, les derniers échanges et les extraits les plus proches de la question
+# trouvés dans toutes les conversations de l'utilisateur (index local d'embeddings)
+MEMORY_CONTEXT_BUDGET = 3000
+MEMORY_TOP_K = 5
+MEMORY_MIN_SCORE = 0.2
+MEMORY_MIN_CHARS = 20  # messages plus courts non indexés ("merci", "ok"...)
+MEMORY_SNIPPET_CHARS = 600
+MEMORY_MAX_USERS = int(os.getenv("MEMORY_MAX_USERS", "100"))
+# Messages indexés par utilisateur (les plus récents) : ~4 Mo de vecteurs par index
+MEMORY_MAX_ENTRIES_PER_USER = int(os.getenv("MEMORY_MAX_ENTRIES_PER_USER", "2000"))
+MEMORY_BUILD_PAGE_SIZE = 200
 
 # Vérifier la configuration
 if not SUPABASE_URL or not SUPABASE_KEY:
@@ -34,6 +198,140 @@ if not GROQ_API_KEY:
     st.error("⚠️ Clé API Groq manquante.")
     st.stop()
 
+# Traçage des appels
+trace_logger = logging.getLogger("frejus.trace")
+# Liste des spans du rerun en cours (absente dans les threads d'arrière-plan)
+current_rerun_trace = contextvars.ContextVar("current_rerun_trace", default=None)
+
+class TraceRegistry:
+    """Agrégats par opération pour tout le processus (exportables au format Prometheus)"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.tokens = {}
+        self.reruns = 0
+    
+    def record(self, span):
+        with self.lock:
+            stats = self.operations.setdefault(span['operation'], {
+                'count': 0, 'errors': 0, 'duration': 0.0, 'max': 0.0,
+                'rows': 0, 'bytes': 0, 'buckets': [0] * len(TRACE_BUCKETS)
+            })
+            stats['count'] += 1
+            stats['errors'] += 1 if span.get('error') else 0
+            stats['duration'] += span['duration']
+            stats['max'] = max(stats['max'], span['duration'])
+            stats['rows'] += span.get('rows') or 0
+            stats['bytes'] += span.get('bytes') or 0
+            for index, bound in enumerate(TRACE_BUCKETS):
+                if span['duration'] <= bound:
+                    stats['buckets'][index] += 1
+            if span.get('model'):
+                tokens = self.tokens.setdefault(span['model'], {'prompt': 0, 'completion': 0})
+                tokens['prompt'] += span.get('prompt_tokens') or 0
+                tokens['completion'] += span.get('completion_tokens') or 0
+    
+    def snapshot(self):
+        with self.lock:
+            operations = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self.operations.items()}
+            return operations, {model: dict(tokens) for model, tokens in self.tokens.items()}, self.reruns
+    
+    def to_prometheus(self):
+        operations, tokens, reruns = self.snapshot()
+        lines = [
+            "# HELP frejus_reruns_total Reruns du script Streamlit.",
+            "# TYPE frejus_reruns_total counter",
+            f"frejus_reruns_total {reruns}",
+            "# HELP frejus_operation_duration_seconds Durée des appels Supabase et Groq.",
+            "# TYPE frejus_operation_duration_seconds histogram"
+        ]
+        for name, stats in sorted(operations.items()):
+            for bound, count in zip(TRACE_BUCKETS, stats['buckets']):
+                lines.append(f'frejus_operation_duration_seconds_bucket{{operation="{name}",le="{bound}"}} {count}')
+            lines.append(f'frejus_operation_duration_seconds_bucket{{operation="{name}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'frejus_operation_duration_seconds_sum{{operation="{name}"}} {stats["duration"]:.6f}')
+            lines.append(f'frejus_operation_duration_seconds_count{{operation="{name}"}} {stats["count"]}')
+        for metric, key, description in (
+            ("frejus_operation_errors_total", "errors", "Appels en erreur."),
+            ("frejus_operation_rows_total", "rows", "Lignes renvoyées ou écrites."),
+            ("frejus_operation_bytes_total", "bytes", "Taille approximative des données transférées.")
+        ):
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stats in sorted(operations.items()):
+                lines.append(f'{metric}{{operation="{name}"}} {stats[key]}')
+        lines.append("# HELP frejus_groq_tokens_total Tokens consommés (champ usage de Groq).")
+        lines.append("# TYPE frejus_groq_tokens_total counter")
+        for model, counts in sorted(tokens.items()):
+            for kind, count in counts.items():
+                lines.append(f'frejus_groq_tokens_total{{model="{model}",kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def init_trace_registry():
+    return TraceRegistry()
+
+trace_registry = init_trace_registry()
+
+def payload_size(value):
+    """Taille approximative (caractères) d'un résultat, sans le resérialiser"""
+    if isinstance(value, list):
+        return sum(payload_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(len(str(key)) + payload_size(item) for key, item in value.items())
+    if value is None or isinstance(value, bool):
+        return 0
+    return len(str(value))
+
+@contextlib.contextmanager
+def trace_span(operation, **attributes):
+    """Mesurer un appel ; les attributs (rows, bytes, model, tokens...) peuvent être complétés dans le bloc"""
+    span = dict(attributes, operation=operation)
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            span['error'] = type(e).__name__
+        raise
+    finally:
+        span['duration'] = time.perf_counter() - started
+        if TRACE_ENABLED:
+            trace_registry.record(span)
+            rerun_trace = current_rerun_trace.get()
+            if rerun_trace is not None:
+                rerun_trace.append(span)
+            if trace_logger.isEnabledFor(logging.INFO):
+                trace_logger.info(json.dumps(span, default=str))
+
+def traced(operation):
+    """Décorateur : tracer une fonction d'accès aux données (lignes et taille du résultat)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(operation) as span:
+                result = func(*args, **kwargs)
+                if isinstance(result, (list, dict)):
+                    span['rows'] = len(result) if isinstance(result, list) else 1
+                    span['bytes'] = payload_size(result)
+                return result
+        return wrapper
+    return decorator
+
+def start_rerun_trace():
+    """Nouveau rerun : archiver les spans du précédent et repartir d'une liste vide"""
+    if not TRACE_ENABLED:
+        return
+    if 'rerun_trace' in st.session_state:
+        st.session_state.last_rerun_trace = st.session_state.rerun_trace
+    st.session_state.rerun_trace = []
+    current_rerun_trace.set(st.session_state.rerun_trace)
+    with trace_registry.lock:
+        trace_registry.reruns += 1
+
+start_rerun_trace()
+
 # Initialiser Supabase
 @st.cache_resource
 def init_supabase():
@@ -41,6 +339,333 @@ def init_supabase():
 
 supabase: Client = init_supabase()
 
+# Session HTTP partagée par tout le processus pour réutiliser les connexions TLS vers Groq
+@st.cache_resource
+def init_groq_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GROQ_POOL_SIZE, pool_block=False)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"})
+    return session
+
+groq_session = init_groq_session()
+
+class ResponseCache:
+    """Cache de réponses à deux niveaux : LRU en mémoire puis SQLite persistant"""
+    
+    def __init__(self, path, memory_entries, ttl, max_bytes):
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.db.commit()
+        self.prune()
+    
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[1] > now:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry[0]
+            self.memory.pop(key, None)
+            
+            row = self.db.execute("SELECT response, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and row[1] > now:
+                self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self.db.commit()
+                self._remember(key, row[0], row[1])
+                self.stats['disk_hits'] += 1
+                return row[0]
+            if row:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+            self.stats['misses'] += 1
+            return None
+    
+    def put(self, key, response):
+        now = time.time()
+        expires_at = now + self.ttl
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            self._remember(key, response, expires_at)
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, expires_at, now)
+            )
+            self.db.commit()
+            self.stats['stores'] += 1
+            if self.stats['stores'] % 50 == 0:
+                self._prune(now)
+    
+    def prune(self):
+        with self.lock:
+            self._prune(time.time())
+    
+    def _remember(self, key, response, expires_at):
+        self.memory[key] = (response, expires_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+    
+    def _prune(self, now):
+        """Supprimer les entrées expirées puis les moins récemment utilisées au-delà de la taille maximale"""
+        deleted = self.db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.memory.pop(key, None)
+                total -= size
+                deleted += 1
+        self.db.commit()
+        self.stats['evictions'] += deleted
+
+@st.cache_resource
+def init_response_cache():
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    try:
+        return ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+    except sqlite3.Error:
+        return None
+
+response_cache = init_response_cache()
+
+class ModelRouter:
+    """Statistiques de latence par modèle (moyennes mobiles) et choix du modèle le plus rapide adapté"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+        # Une entrée par requête Groq récente : True si elle a été doublée
+        self.recent_requests = deque(maxlen=HEDGE_RATE_WINDOW)
+    
+    def _stats(self, model):
+        ttft, tokens_per_second = ROUTER_PRIORS.get(model, (0.5, 250))
+        return self.models.setdefault(model, {
+            'ttft': ttft,
+            'tokens_per_second': tokens_per_second,
+            'ttft_samples': deque(maxlen=200),
+            'failures': 0,
+            'cooldown_until': 0.0
+        })
+    
+    def record_success(self, model, ttft=None, completion_tokens=None, duration=None):
+        with self.lock:
+            stats = self._stats(model)
+            stats['failures'] = 0
+            stats['cooldown_until'] = 0.0
+            if ttft is not None:
+                stats['ttft'] += ROUTER_EWMA_ALPHA * (ttft - stats['ttft'])
+                stats['ttft_samples'].append(ttft)
+            if completion_tokens and duration:
+                generation_time = duration - (ttft if ttft is not None else stats['ttft'])
+                if generation_time > 0:
+                    stats['tokens_per_second'] += ROUTER_EWMA_ALPHA * (completion_tokens / generation_time - stats['tokens_per_second'])
+    
+    def record_slow_start(self, model, elapsed):
+        """Requête abandonnée sans premier token : son TTFT vaut au moins elapsed"""
+        with self.lock:
+            stats = self._stats(model)
+            stats['ttft'] += ROUTER_EWMA_ALPHA * (max(elapsed, stats['ttft']) - stats['ttft'])
+            stats['ttft_samples'].append(elapsed)
+    
+    def record_failure(self, model, error):
+        """Écarter temporairement un modèle en erreur ou limité par le quota"""
+        with self.lock:
+            stats = self._stats(model)
+            stats['failures'] += 1
+            if error.status_code == 429:
+                cooldown = error.retry_after or 30
+            else:
+                cooldown = 2 ** stats['failures']
+            stats['cooldown_until'] = time.time() + min(cooldown, ROUTER_MAX_COOLDOWN)
+    
+    def hedge_delay(self, model):
+        """Attente du premier token avant de lancer une requête de secours"""
+        with self.lock:
+            samples = sorted(self._stats(model)['ttft_samples'])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        delay = samples[min(len(samples) - 1, int(HEDGE_PERCENTILE * len(samples)))]
+        return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+    
+    def record_request(self):
+        with self.lock:
+            self.recent_requests.append(False)
+    
+    def allow_hedge(self):
+        """Réserver une requête de secours si le plafond n'est pas atteint"""
+        with self.lock:
+            if sum(self.recent_requests) >= HEDGE_MAX_RATE * HEDGE_RATE_WINDOW:
+                return False
+            self.recent_requests.append(True)
+            return True
+    
+    def expected_latency(self, model, output_tokens):
+        stats = self._stats(model)
+        return stats['ttft'] + output_tokens / max(stats['tokens_per_second'], 1)
+    
+    def rank(self, candidates, prompt_tokens, max_tokens, code_mode=False, design_mode=False):
+        """Modèles candidats du plus adapté au moins adapté (les suivants servent de repli)"""
+        # Longueur de réponse typique : un quart du maximum autorisé
+        output_tokens = max_tokens // 4
+        simple_prompt = not (code_mode or design_mode) and prompt_tokens <= ROUTER_SHORT_PROMPT_TOKENS
+        now = time.time()
+        with self.lock:
+            def sort_key(model):
+                fits = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT) > prompt_tokens + max_tokens
+                capable = simple_prompt or model not in ROUTER_SMALL_MODELS
+                available = self._stats(model)['cooldown_until'] <= now
+                return (not fits, not available, not capable, self.expected_latency(model, output_tokens))
+            return sorted(candidates, key=sort_key)
+
+@st.cache_resource
+def init_model_router():
+    return ModelRouter()
+
+model_router = init_model_router()
+
+class AdmissionController:
+    """Admission des requêtes Groq : seau de tokens par utilisateur, plafond de requêtes simultanées, file équitable"""
+    
+    def __init__(self, max_concurrent, bucket_tokens, refill_per_second):
+        self.max_concurrent = max_concurrent
+        self.bucket_tokens = bucket_tokens
+        self.refill_per_second = refill_per_second
+        self.condition = threading.Condition()
+        # user_id -> [tokens disponibles, dernier remplissage] ; pas d'entrée équivaut à un seau plein
+        self.buckets = {}
+        # user_id -> requêtes admises en cours
+        self.active = {}
+        self.waiting = []
+        self.sequence = 0
+    
+    def _bucket(self, user_id, now):
+        bucket = self.buckets.setdefault(user_id, [self.bucket_tokens, now])
+        bucket[0] = min(self.bucket_tokens, bucket[0] + (now - bucket[1]) * self.refill_per_second)
+        bucket[1] = now
+        return bucket
+    
+    def _queue_order(self):
+        """Ordre de service : utilisateurs ayant le moins de requêtes en cours d'abord, puis ordre d'arrivée"""
+        return sorted(self.waiting, key=lambda ticket: (self.active.get(ticket['user_id'], 0), ticket['sequence']))
+    
+    def _admit_waiting(self):
+        """Admettre les tickets servables ; un utilisateur à court de tokens ne bloque pas les suivants"""
+        now = time.monotonic()
+        admitted = False
+        for ticket in self._queue_order():
+            if sum(self.active.values()) >= self.max_concurrent:
+                break
+            bucket = self._bucket(ticket['user_id'], now)
+            if bucket[0] < ticket['cost']:
+                continue
+            bucket[0] -= ticket['cost']
+            self.active[ticket['user_id']] = self.active.get(ticket['user_id'], 0) + 1
+            self.waiting.remove(ticket)
+            ticket['admitted'] = True
+            admitted = True
+        self._forget_full_buckets(now)
+        if admitted:
+            self.condition.notify_all()
+    
+    def _forget_full_buckets(self, now):
+        """Oublier les seaux redevenus pleins des utilisateurs sans requête en cours ni en attente"""
+        waiting_users = {ticket['user_id'] for ticket in self.waiting}
+        for user_id, (tokens, refilled_at) in list(self.buckets.items()):
+            if user_id in self.active or user_id in waiting_users:
+                continue
+            if tokens + (now - refilled_at) * self.refill_per_second >= self.bucket_tokens:
+                del self.buckets[user_id]
+    
+    def enqueue(self, user_id, cost):
+        with self.condition:
+            self.sequence += 1
+            # Une requête plus coûteuse que le seau entier doit rester possible
+            ticket = {'user_id': user_id, 'cost': min(cost, self.bucket_tokens), 'sequence': self.sequence, 'admitted': False}
+            self.waiting.append(ticket)
+            self._admit_waiting()
+            return ticket
+    
+    def wait(self, ticket, timeout):
+        """Attendre l'admission au plus timeout secondes ; renvoie True si le ticket est admis"""
+        with self.condition:
+            if not ticket['admitted']:
+                # Réveil sur libération d'une place, ou à l'échéance pour tenir compte du remplissage des seaux
+                self.condition.wait(timeout)
+                self._admit_waiting()
+            return ticket['admitted']
+    
+    def status(self, ticket):
+        """Position dans la file (1 = prochain servi) et attente due au seau de l'utilisateur (secondes)"""
+        with self.condition:
+            if ticket['admitted']:
+                return {'position': 0, 'throttled_for': 0.0}
+            queue_order = self._queue_order()
+            position = queue_order.index(ticket) + 1 if ticket in queue_order else 0
+            missing = ticket['cost'] - self._bucket(ticket['user_id'], time.monotonic())[0]
+            return {'position': position, 'throttled_for': max(0.0, missing / self.refill_per_second)}
+    
+    def try_admit(self, user_id, cost):
+        """Admission immédiate d'une requête facultative (secours), sans file.
+        None si quelqu'un attend déjà, si le plafond est atteint ou si le seau est insuffisant."""
+        with self.condition:
+            cost = min(cost, self.bucket_tokens)
+            if self.waiting or sum(self.active.values()) >= self.max_concurrent:
+                return None
+            bucket = self._bucket(user_id, time.monotonic())
+            if bucket[0] < cost:
+                return None
+            bucket[0] -= cost
+            self.active[user_id] = self.active.get(user_id, 0) + 1
+            return {'user_id': user_id, 'cost': cost, 'sequence': None, 'admitted': True}
+    
+    def release(self, ticket, used_tokens=None):
+        """Fin de la requête : libérer la place et rendre les tokens réservés non consommés"""
+        with self.condition:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            elif ticket['admitted']:
+                ticket['admitted'] = False
+                user_id = ticket['user_id']
+                self.active[user_id] -= 1
+                if not self.active[user_id]:
+                    del self.active[user_id]
+                if used_tokens is not None and used_tokens < ticket['cost']:
+                    bucket = self._bucket(user_id, time.monotonic())
+                    bucket[0] = min(self.bucket_tokens, bucket[0] + ticket['cost'] - used_tokens)
+            self._admit_waiting()
+            self.condition.notify_all()
+    
+    def snapshot(self):
+        with self.condition:
+            return {'active': sum(self.active.values()), 'waiting': len(self.waiting), 'users': len(self.active)}
+
+@st.cache_resource
+def init_admission_controller():
+    return AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_BUCKET_TOKENS, ADMISSION_REFILL_PER_SECOND)
+
+admission_controller = init_admission_controller()
+
 # Fonctions pour gérer les cookies via localStorage (plus fiable que les cookies)
 def set_local_storage(key, value):
     """Sauvegarder dans localStorage"""
@@ -96,20 +721,97 @@ def clear_local_storage(key):
     components.html(js_code, height=0)
 
 # Fonctions d'authentification
+def parse_timestamp(value):
+    """Convertir un horodatage ISO de Supabase en datetime UTC"""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+class SessionCache:
+    """Cache LRU borné des sessions validées, indexé par le hash du token"""
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+    
+    def get(self, token):
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, valid_until = entry
+            if time.time() >= valid_until:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user
+    
+    def put(self, token, user, expires_at):
+        # Jamais au-delà de l'expiration réelle de la session
+        valid_until = min(time.time() + self.ttl, expires_at.timestamp())
+        with self.lock:
+            self.entries[self.key(token)] = (user, valid_until)
+            self.entries.move_to_end(self.key(token))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, token):
+        with self.lock:
+            self.entries.pop(self.key(token), None)
+    
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in [key for key, (user, _) in self.entries.items() if user['id'] == user_id]:
+                del self.entries[key]
+
+@traced("supabase.sweep_expired_sessions")
+def sweep_expired_sessions():
+    """Supprimer en une requête toutes les sessions expirées"""
+    try:
+        supabase.table('sessions').delete().lt('expires_at', datetime.now(timezone.utc).isoformat()).execute()
+        return True
+    except:
+        return False
+
+def run_session_sweeper():
+    while True:
+        sweep_expired_sessions()
+        time.sleep(SESSION_SWEEP_INTERVAL)
+
+@st.cache_resource
+def init_session_cache():
+    # Le nettoyage tourne une fois par processus, en arrière-plan
+    threading.Thread(target=run_session_sweeper, name="session-sweeper", daemon=True).start()
+    return SessionCache(SESSION_CACHE_TTL, SESSION_CACHE_MAX_ENTRIES)
+
+session_cache = init_session_cache()
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def generate_session_token():
     return python_secrets.token_urlsafe(32)
 
+@traced("supabase.create_session")
 def create_session(user_id, username):
     """Créer une session persistante"""
     try:
         token = generate_session_token()
-        expires_at = (datetime.now() + timedelta(days=30)).isoformat()
+        expires_at = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
         
         # Supprimer les anciennes sessions de cet utilisateur
         supabase.table('sessions').delete().eq('user_id', user_id).execute()
+        session_cache.invalidate_user(user_id)
         
         # Créer la nouvelle session
         supabase.table('sessions').insert({
@@ -123,57 +825,71 @@ def create_session(user_id, username):
         st.error(f"Erreur création session: {str(e)}")
         return None
 
+@traced("supabase.get_session")
 def get_session(token):
     """Vérifier si une session est valide"""
     if not token:
         return None
     
     try:
+        user = session_cache.get(token)
+        if user:
+            return user
+        
         result = supabase.table('sessions').select('user_id, expires_at, users(id, username, email)').eq('token', token).execute()
         
         if result.data and len(result.data) > 0:
             session = result.data[0]
-            expires_str = session['expires_at']
-            
-            # Gérer différents formats de date
-            if expires_str.endswith('Z'):
-                expires_str = expires_str.replace('Z', '+00:00')
-            
-            expires_at = datetime.fromisoformat(expires_str)
-            
-            # Rendre aware si nécessaire
-            if expires_at.tzinfo is None:
-                from datetime import timezone
-                expires_at = expires_at.replace(tzinfo=timezone.utc)
-                now = datetime.now(timezone.utc)
-            else:
-                now = datetime.now(expires_at.tzinfo)
+            expires_at = parse_timestamp(session['expires_at'])
             
             # Vérifier si la session n'est pas expirée
-            if now < expires_at:
+            if datetime.now(timezone.utc) < expires_at:
                 user = session['users']
-                return {
+                user = {
                     'id': user['id'],
                     'username': user['username'],
                     'email': user['email']
                 }
+                session_cache.put(token, user, expires_at)
+                return user
         
         return None
     except Exception as e:
         st.error(f"Erreur vérification session: {str(e)}")
         return None
 
+@traced("supabase.delete_session")
 def delete_session(token):
     """Supprimer une session"""
+    session_cache.invalidate(token)
     try:
         supabase.table('sessions').delete().eq('token', token).execute()
         return True
     except:
         return False
 
+@traced("supabase.register_user")
 def register_user(username, password, email):
+    """Créer le compte et sa première conversation (un seul appel à register_user_with_conversation)"""
     try:
-        result = supabase.table('users').select('*').eq('username', username).execute()
+        result = supabase.rpc('register_user_with_conversation', {
+            'p_username': username,
+            'p_password_hash': hash_password(password),
+            'p_email': email
+        }).execute()
+        status = result.data[0]['status'] if result.data else None
+        if status == 'ok':
+            return True, "Compte créé avec succès !"
+        if status == 'username_taken':
+            return False, "Nom d'utilisateur déjà pris"
+        return False, "Erreur lors de la création du compte"
+    except Exception as e:
+        if getattr(e, 'code', None) != 'PGRST202':
+            return False, f"Erreur: {str(e)}"
+    
+    # Fonction absente (migration non appliquée) : requêtes séparées
+    try:
+        result = supabase.table('users').select('id').eq('username', username).execute()
         if result.data:
             return False, "Nom d'utilisateur déjà pris"
         
@@ -194,11 +910,14 @@ def register_user(username, password, email):
         
         return False, "Erreur lors de la création du compte"
     except Exception as e:
+        if getattr(e, 'code', None) == '23505':
+            return False, "Nom d'utilisateur déjà pris"
         return False, f"Erreur: {str(e)}"
 
+@traced("supabase.login_user")
 def login_user(username, password):
     try:
-        result = supabase.table('users').select('*').eq('username', username).execute()
+        result = supabase.table('users').select('id, password_hash').eq('username', username).execute()
         
         if not result.data:
             return False, "Utilisateur introuvable", None
@@ -211,6 +930,46 @@ def login_user(username, password):
     except Exception as e:
         return False, f"Erreur: {str(e)}", None
 
+@traced("supabase.login_with_session")
+def login_with_session(username, password):
+    """Vérifier les identifiants et créer la session en un seul appel (fonction Postgres login_with_session).
+    Renvoie (succès, message, utilisateur, token)."""
+    token = generate_session_token()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=30)
+    try:
+        result = supabase.rpc('login_with_session', {
+            'p_username': username,
+            'p_password_hash': hash_password(password),
+            'p_token': token,
+            'p_expires_at': expires_at.isoformat()
+        }).execute()
+    except Exception as e:
+        if getattr(e, 'code', None) != 'PGRST202':
+            return False, f"Erreur: {str(e)}", None, None
+        # Fonction absente (migration non appliquée) : vérification puis création de session
+        success, message, user_id = login_user(username, password)
+        if not success:
+            return False, message, None, None
+        token = create_session(user_id, username)
+        if not token:
+            return False, "❌ Erreur lors de la création de la session", None, None
+        return True, message, {'id': user_id, 'username': username}, token
+    
+    row = result.data[0] if result.data else {}
+    if row.get('status') == 'unknown_user':
+        return False, "Utilisateur introuvable", None, None
+    if row.get('status') == 'bad_password':
+        return False, "Mot de passe incorrect", None, None
+    if row.get('status') != 'ok':
+        return False, "Erreur lors de la connexion", None, None
+    
+    user = {'id': row['user_id'], 'username': row['username'], 'email': row['email']}
+    # Anciennes sessions supprimées par la fonction ; la nouvelle est déjà validée
+    session_cache.invalidate_user(user['id'])
+    session_cache.put(token, user, expires_at)
+    return True, "Connexion réussie !", user, token
+
+@traced("supabase.get_user_conversations")
 def get_user_conversations(user_id):
     try:
         result = supabase.table('conversations').select('*').eq('user_id', user_id).order('created_at').execute()
@@ -218,24 +977,115 @@ def get_user_conversations(user_id):
     except:
         return []
 
-def get_conversation_messages(conversation_id):
+@traced("supabase.get_conversation_stats")
+def get_conversation_stats(user_id):
+    """Statistiques de toutes les conversations en un seul appel (compteurs tenus côté serveur)"""
     try:
-        result = supabase.table('messages').select('*').eq('conversation_id', conversation_id).order('created_at').execute()
-        return result.data
+        result = supabase.table('conversations').select('id, message_count, total_chars, last_message_at').eq('user_id', user_id).execute()
+        return {
+            row['id']: {
+                'message_count': row['message_count'],
+                'total_chars': row['total_chars'],
+                'last_activity': row['last_message_at']
+            }
+            for row in result.data
+        }
     except:
-        return []
+        pass
+    
+    # Base sans les compteurs : requêtes de comptage seules (aucun contenu transféré)
+    stats = {}
+    for conv in get_user_conversations(user_id):
+        try:
+            result = supabase.table('messages').select('id', count='exact', head=True).eq('conversation_id', conv['id']).execute()
+            message_count = result.count or 0
+        except:
+            message_count = 0
+        stats[conv['id']] = {'message_count': message_count, 'total_chars': None, 'last_activity': None}
+    return stats
+
+def record_message_stats(conversation_id, content):
+    """Mettre à jour localement les statistiques après l'enregistrement d'un message"""
+    stats = st.session_state.setdefault('conversation_stats', {}).setdefault(
+        conversation_id, {'message_count': 0, 'total_chars': 0, 'last_activity': None}
+    )
+    stats['message_count'] += 1
+    if stats['total_chars'] is not None:
+        stats['total_chars'] += len(content)
+    stats['last_activity'] = datetime.now(timezone.utc).isoformat()
+
+@traced("supabase.get_conversation_summary")
+def get_conversation_summary(conversation_id):
+    """Récupérer le résumé glissant d'une conversation"""
+    try:
+        result = supabase.table('conversation_summaries').select('summary, summarized_until').eq('conversation_id', conversation_id).execute()
+        return result.data[0] if result.data else None
+    except:
+        return None
 
-def save_message(conversation_id, role, content):
+@traced("supabase.save_conversation_summary")
+def save_conversation_summary(conversation_id, summary, summarized_until):
     try:
-        supabase.table('messages').insert({
+        supabase.table('conversation_summaries').upsert({
             'conversation_id': conversation_id,
-            'role': role,
-            'content': content
-        }).execute()
+            'summary': summary,
+            'summarized_until': summarized_until,
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }, on_conflict='conversation_id').execute()
         return True
     except:
         return False
 
+@traced("supabase.get_messages_since")
+def get_messages_since(conversation_id, created_at):
+    """Récupérer uniquement les messages créés depuis created_at (inclus)"""
+    try:
+        query = supabase.table('messages').select('*').eq('conversation_id', conversation_id)
+        if created_at:
+            query = query.gte('created_at', created_at)
+        result = query.order('created_at').order('id').execute()
+        return result.data
+    except:
+        return []
+
+@traced("supabase.get_messages_before")
+def get_messages_before(conversation_id, before=None, limit=CHAT_WINDOW_SIZE):
+    """Page de messages précédant before (created_at, id), par pagination keyset, en ordre chronologique"""
+    try:
+        query = supabase.table('messages').select('*').eq('conversation_id', conversation_id)
+        if before:
+            created_at, message_id = before
+            query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{message_id}")')
+        result = query.order('created_at', desc=True).order('id', desc=True).limit(limit).execute()
+        return list(reversed(result.data))
+    except:
+        return []
+
+@traced("supabase.get_segment_before")
+def get_segment_before(conversation_id, before=None):
+    """Segment compacté le plus récent précédant before (created_at, id), None s'il n'y en a pas"""
+    try:
+        query = supabase.table('message_segments').select('*').eq('conversation_id', conversation_id)
+        if before:
+            created_at, message_id = before
+            query = query.or_(f'last_created_at.lt."{created_at}",and(last_created_at.eq."{created_at}",last_message_id.lt."{message_id}")')
+        result = query.order('last_created_at', desc=True).order('last_message_id', desc=True).limit(1).execute()
+        return result.data[0] if result.data else None
+    except:
+        return None
+
+def get_history_page(conversation_id, before=None, limit=CHAT_WINDOW_SIZE):
+    """Page d'historique précédant before, segments compactés compris ; renvoie (messages, has_more)"""
+    page = get_messages_before(conversation_id, before, limit)
+    if len(page) == limit:
+        return page, True
+    # Plus de lignes : l'historique plus ancien est peut-être compacté, décompressé seulement maintenant
+    segment = get_segment_before(conversation_id, (page[0]['created_at'], page[0]['id']) if page else before)
+    if segment:
+        return compaction.decode_segment(segment) + page, True
+    return page, False
+
+@traced("supabase.create_conversation")
 def create_conversation(user_id, name):
     try:
         result = supabase.table('conversations').insert({
@@ -246,20 +1096,369 @@ def create_conversation(user_id, name):
     except:
         return None
 
+@traced("supabase.delete_conversation")
 def delete_conversation(conversation_id):
     try:
         supabase.table('conversations').delete().eq('id', conversation_id).execute()
+        invalidate_message_cache(conversation_id)
         return True
     except:
         return False
 
+@traced("supabase.rename_conversation")
 def rename_conversation(conversation_id, new_name):
+    """Renommer une conversation ; renvoie la ligne mise à jour (None si introuvable ou en erreur)"""
+    try:
+        result = supabase.table('conversations').update({'name': new_name}).eq('id', conversation_id).execute()
+        return result.data[0] if result.data else None
+    except:
+        return None
+
+@traced("supabase.save_attachments")
+def save_attachments(user_id, attachments):
+    """Enregistrer les images préparées (dédoublonnées par empreinte SHA-256)"""
     try:
-        supabase.table('conversations').update({'name': new_name}).eq('id', conversation_id).execute()
+        supabase.table('message_attachments').upsert([{
+            'sha256': image['sha256'],
+            'user_id': user_id,
+            'mime_type': image['mime_type'],
+            'width': image['width'],
+            'height': image['height'],
+            'byte_size': len(image['data']),
+            'data': base64.b64encode(image['data']).decode('ascii')
+        } for image in attachments], on_conflict='sha256', ignore_duplicates=True).execute()
         return True
     except:
         return False
 
+@traced("supabase.get_attachment")
+def get_attachment_data(sha256):
+    try:
+        result = supabase.table('message_attachments').select('data').eq('sha256', sha256).execute()
+        return base64.b64decode(result.data[0]['data']) if result.data else None
+    except:
+        return None
+
+def make_search_snippet(content, query):
+    """Extrait autour de la première occurrence, mots recherchés en gras (comme ts_headline)"""
+    words = [re.escape(word) for word in query.split() if len(word) >= SEARCH_MIN_LENGTH]
+    pattern = re.compile("|".join(words), re.IGNORECASE) if words else None
+    match = pattern.search(content) if pattern else None
+    start = max(0, match.start() - SEARCH_SNIPPET_CHARS // 3) if match else 0
+    snippet = " ".join(content[start:start + SEARCH_SNIPPET_CHARS].split())
+    if pattern:
+        snippet = pattern.sub(lambda found: f"**{found.group(0)}**", snippet)
+    return ("… " if start else "") + snippet + (" …" if start + SEARCH_SNIPPET_CHARS < len(content) else "")
+
+@traced("supabase.search_messages")
+def search_messages(user_id, query, conversations):
+    """Messages de l'utilisateur correspondant à query, classés, avec extrait (index plein texte côté Postgres)"""
+    try:
+        result = supabase.rpc('search_messages', {
+            'p_user_id': user_id,
+            'p_query': query,
+            'p_limit': SEARCH_RESULTS_LIMIT
+        }).execute()
+        return result.data
+    except Exception as e:
+        if getattr(e, 'code', None) != 'PGRST202':
+            return []
+    
+    # Fonction search_messages absente (migration non appliquée) : recherche ilike, sans classement
+    try:
+        escaped = re.sub(r'([%_\\])', r'\\\1', query)
+        result = supabase.table('messages').select('id, conversation_id, role, content, created_at').in_(
+            'conversation_id', list(conversations)
+        ).ilike('content', f'%{escaped}%').order('created_at', desc=True).limit(SEARCH_RESULTS_LIMIT).execute()
+        return [{
+            'message_id': msg['id'],
+            'conversation_id': msg['conversation_id'],
+            'conversation_name': conversations.get(msg['conversation_id'], ''),
+            'role': msg['role'],
+            'created_at': msg['created_at'],
+            'snippet': make_search_snippet(msg['content'], query),
+            'rank': None
+        } for msg in result.data]
+    except:
+        return []
+
+# Écriture différée des messages
+class MessageWriter:
+    """File d'écriture : les messages d'un tour sont insérés en un seul lot, hors du script Streamlit"""
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = {}
+        self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self.thread.start()
+    
+    def enqueue(self, rows):
+        with self.lock:
+            for row in rows:
+                self.pending[row['conversation_id']] = self.pending.get(row['conversation_id'], 0) + 1
+        self.queue.put(rows)
+    
+    def pending_count(self, conversation_id=None):
+        """Nombre de messages pas encore écrits (pour une conversation ou au total)"""
+        with self.lock:
+            if conversation_id is None:
+                return sum(self.pending.values())
+            return self.pending.get(conversation_id, 0)
+    
+    def pop_failed(self, conversation_id):
+        """Messages abandonnés après toutes les tentatives"""
+        with self.lock:
+            return self.failed.pop(conversation_id, [])
+    
+    def flush(self, timeout=10):
+        """Attendre que la file soit vide (au plus timeout secondes)"""
+        deadline = time.monotonic() + timeout
+        while self.pending_count() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.pending_count() == 0
+    
+    def _run(self):
+        while True:
+            batches = [list(self.queue.get())]
+            # Regrouper les lots déjà en attente : un seul aller-retour pour tous.
+            # Un seul thread écrit, dans l'ordre d'arrivée : l'ordre par conversation est conservé
+            while True:
+                try:
+                    batches.append(list(self.queue.get_nowait()))
+                except queue.Empty:
+                    break
+            self._write(batches)
+    
+    def _insert(self, rows):
+        """Insérer des lignes avec reprises ; renvoie (écrites, erreur de données)"""
+        for attempt in range(WRITE_MAX_ATTEMPTS):
+            try:
+                with trace_span("supabase.write_messages", rows=len(rows), bytes=payload_size(rows)):
+                    supabase.table('messages').insert(rows).execute()
+                return True, False
+            except Exception as e:
+                code = str(getattr(e, 'code', '') or '')
+                if code == 'PGRST204' and any(column in row for row in rows for column in OPTIONAL_MESSAGE_COLUMNS):
+                    # Colonne facultative absente (migration non appliquée) : écrire sans elle
+                    rows = [{key: value for key, value in row.items() if key not in OPTIONAL_MESSAGE_COLUMNS} for row in rows]
+                    continue
+                if code.startswith(('22', '23', 'PGRST2')):
+                    # Erreur de données (conversation supprimée, valeur invalide) : inutile de réessayer
+                    return False, True
+                if attempt < WRITE_MAX_ATTEMPTS - 1:
+                    time.sleep(min(WRITE_BACKOFF_MAX, WRITE_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1))
+        return False, False
+    
+    def _write(self, batches):
+        written, data_error = self._insert([row for batch in batches for row in batch])
+        if written or not data_error or len(batches) == 1:
+            results = [(batch, written) for batch in batches]
+        else:
+            # Une ligne refusée fait échouer tout l'insert groupé : réécrire chaque tour
+            # séparément pour que seuls les messages fautifs soient perdus
+            results = [(batch, self._insert(batch)[0]) for batch in batches]
+        
+        with self.lock:
+            for batch, batch_written in results:
+                for row in batch:
+                    conversation_id = row['conversation_id']
+                    self.pending[conversation_id] -= 1
+                    if not self.pending[conversation_id]:
+                        del self.pending[conversation_id]
+                    if not batch_written:
+                        self.failed.setdefault(conversation_id, []).append(row)
+
+@st.cache_resource
+def init_message_writer():
+    writer = MessageWriter()
+    atexit.register(writer.flush)
+    return writer
+
+message_writer = init_message_writer()
+
+# Lectures parallèles
+@st.cache_resource
+def init_page_loader():
+    return ThreadPoolExecutor(max_workers=PAGE_LOAD_WORKERS, thread_name_prefix="frejus-load")
+
+page_loader = init_page_loader()
+
+@st.cache_resource
+def init_background_pool():
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="frejus-background")
+
+background_pool = init_background_pool()
+
+def run_concurrently(reads, executor=None):
+    """Exécuter des lectures indépendantes {nom: (fonction, *arguments)} en parallèle ; renvoie {nom: résultat}.
+    Chaque lecture garde le contexte du rerun (traçage) ; elles ne doivent pas toucher st.session_state.
+    executor : page_loader par défaut (lectures d'un rerun).
+    """
+    if len(reads) <= 1:
+        return {name: function(*args) for name, (function, *args) in reads.items()}
+    futures = {
+        name: (executor or page_loader).submit(contextvars.copy_context().run, function, *args)
+        for name, (function, *args) in reads.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+# Mémoire entre conversations
+@st.cache_resource
+def init_memory_store():
+    return memory_index.MemoryStore(MEMORY_MAX_USERS)
+
+memory_store = init_memory_store()
+
+def memory_key(message):
+    """Identifiant d'un message, y compris avant son insertion (created_at est fixé côté client)"""
+    return f"{message['conversation_id']}|{parse_timestamp(message['created_at']).isoformat()}"
+
+def index_messages(index, messages):
+    for msg in messages:
+        content = msg['content'].strip()
+        if len(content) >= MEMORY_MIN_CHARS:
+            index.add({
+                'key': memory_key(msg),
+                'conversation_id': msg['conversation_id'],
+                'role': msg['role'],
+                'created_at': msg['created_at'],
+                'content': content[:MEMORY_SNIPPET_CHARS]
+            }, memory_index.embed(content))
+
+def remember_messages(user_id, messages):
+    """Ajouter les messages enregistrés à l'index de l'utilisateur, s'il est déjà construit"""
+    index = memory_store.get(user_id)
+    if index is not None:
+        index_messages(index, messages)
+
+def queue_messages(conversation_id, new_messages, model=None, attachments=None):
+    """Mettre en file les messages d'un tour [(role, content), ...] et les afficher immédiatement.
+    Le modèle qui a produit la réponse est enregistré avec le message de l'assistant,
+    les images jointes (métadonnées seulement) avec celui de l'utilisateur."""
+    entry = st.session_state.setdefault('message_cache', {}).get(conversation_id)
+    known = (entry['messages'] + entry['pending']) if entry else []
+    # created_at fixé côté client, strictement croissant : un lot inséré en une
+    # transaction aurait sinon le même now() pour tous ses messages
+    created_at = datetime.now(timezone.utc)
+    if known:
+        created_at = max(created_at, parse_timestamp(known[-1]['created_at']) + timedelta(milliseconds=1))
+    
+    rows = []
+    for role, content in new_messages:
+        row = {
+            'conversation_id': conversation_id,
+            'role': role,
+            'content': content,
+            'created_at': created_at.isoformat()
+        }
+        if role == "assistant" and model:
+            row['model'] = model
+        if role == "user" and attachments:
+            row['attachments'] = [
+                {'sha256': image['sha256'], 'width': image['width'], 'height': image['height']}
+                for image in attachments
+            ]
+        rows.append(row)
+        created_at += timedelta(milliseconds=1)
+        record_message_stats(conversation_id, content)
+        if role == "assistant":
+            # Analyse des blocs HTML faite une fois à l'enregistrement, réutilisée à chaque rerun
+            parse_html_segments(content)
+    
+    message_writer.enqueue(rows)
+    if entry:
+        entry['pending'].extend(rows)
+    remember_messages(st.session_state.user_id, rows)
+    # Nouveaux messages : la recherche en cache ne les contiendrait pas
+    st.session_state.pop('search_results', None)
+
+# Cache local des messages (par session et par conversation)
+def plan_message_read(conversation_id):
+    """Lecture nécessaire à get_cached_messages, à lancer avec les autres (None : elle doit rester séquentielle)"""
+    entry = st.session_state.setdefault('message_cache', {}).get(conversation_id)
+    if entry is None:
+        return (get_messages_before, conversation_id)
+    if entry['pending']:
+        # La lecture doit suivre la fin des écritures en file
+        return None
+    return (get_messages_since, conversation_id, entry['messages'][-1]['created_at'] if entry['messages'] else None)
+
+def get_cached_messages(conversation_id, prefetched=None):
+    """Charger la dernière page une seule fois, puis seulement les nouveaux messages.
+    prefetched : résultat de plan_message_read(conversation_id), déjà lu en parallèle.
+    """
+    cache = st.session_state.setdefault('message_cache', {})
+    entry = cache.get(conversation_id)
+    
+    if entry is None:
+        messages = get_messages_before(conversation_id) if prefetched is None else prefetched
+        # Compteur serveur supérieur aux lignes lues : le reste est dans des segments compactés
+        message_count = st.session_state.get('conversation_stats', {}).get(conversation_id, {}).get('message_count') or 0
+        cache[conversation_id] = {
+            'messages': messages,
+            'ids': {msg['id'] for msg in messages},
+            'pending': [],
+            'has_more': len(messages) == CHAT_WINDOW_SIZE or message_count > len(messages),
+            'window': CHAT_WINDOW_SIZE
+        }
+        return messages
+    
+    messages = entry['messages']
+    if entry['pending']:
+        # Écritures encore en file : afficher la copie locale plutôt qu'un historique incomplet
+        if message_writer.pending_count(conversation_id):
+            return messages + entry['pending']
+        entry['pending'] = []
+    # gte + dédoublonnage par id : plusieurs messages peuvent partager le même created_at
+    last_created_at = messages[-1]['created_at'] if messages else None
+    for msg in get_messages_since(conversation_id, last_created_at) if prefetched is None else prefetched:
+        if msg['id'] not in entry['ids']:
+            entry['ids'].add(msg['id'])
+            messages.append(msg)
+    return messages
+
+def get_loaded_history(conversation_id):
+    """Messages déjà en cache (y compris ceux en cours d'écriture), sans requête"""
+    entry = st.session_state.setdefault('message_cache', {}).get(conversation_id)
+    return (entry['messages'] + entry['pending']) if entry else []
+
+def load_older_messages(conversation_id):
+    """Ajouter au cache la page de messages précédant le plus ancien message chargé"""
+    entry = st.session_state.message_cache[conversation_id]
+    if not entry['has_more']:
+        return 0
+    oldest = entry['messages'][0] if entry['messages'] else None
+    before = (oldest['created_at'], oldest['id']) if oldest else None
+    page, has_more = get_history_page(conversation_id, before)
+    page = [msg for msg in page if msg['id'] not in entry['ids']]
+    entry['ids'].update(msg['id'] for msg in page)
+    entry['messages'][:0] = page
+    entry['has_more'] = has_more
+    return len(page)
+
+def load_messages_until(conversation_id, created_at, max_pages=None):
+    """Charger les pages plus anciennes jusqu'à created_at (tout l'historique si None), au plus max_pages pages"""
+    entry = st.session_state.message_cache[conversation_id]
+    limit = parse_timestamp(created_at) if created_at else None
+    loaded = 0
+    while entry['has_more'] and (not entry['messages'] or limit is None or parse_timestamp(entry['messages'][0]['created_at']) > limit):
+        if max_pages is not None and loaded >= max_pages:
+            break
+        if not load_older_messages(conversation_id):
+            break
+        loaded += 1
+    return loaded
+
+def invalidate_message_cache(conversation_id=None):
+    """Vider le cache d'une conversation (ou de toutes)"""
+    cache = st.session_state.setdefault('message_cache', {})
+    if conversation_id is None:
+        cache.clear()
+    else:
+        cache.pop(conversation_id, None)
+
 # Initialiser l'état de session
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
@@ -284,7 +1483,7 @@ if not st.session_state.authenticated:
             st.session_state.username = user['username']
             st.session_state.user_id = user['id']
             st.session_state.session_token = token
-            st.rerun()
+            # Pas de st.rerun() : la suite du script affiche directement l'interface
 
 # Page de connexion/inscription
 if not st.session_state.authenticated:
@@ -309,26 +1508,21 @@ if not st.session_state.authenticated:
         
         if st.button("Se connecter", type="primary", use_container_width=True):
             if login_username and login_password:
-                success, message, user_id = login_user(login_username, login_password)
+                # Identifiants vérifiés et session persistante créée en un seul appel
+                success, message, user, session_token = login_with_session(login_username, login_password)
                 if success:
-                    # Créer une session persistante
-                    session_token = create_session(user_id, login_username)
+                    st.session_state.authenticated = True
+                    st.session_state.username = user['username']
+                    st.session_state.user_id = user['id']
+                    st.session_state.session_token = session_token
                     
-                    if session_token:
-                        st.session_state.authenticated = True
-                        st.session_state.username = login_username
-                        st.session_state.user_id = user_id
-                        st.session_state.session_token = session_token
-                        
-                        # Sauvegarder dans localStorage si "Se souvenir de moi" est coché
-                        if remember_me:
-                            set_local_storage("frejus_session", session_token)
-                        
-                        st.success(message)
-                        st.balloons()
-                        st.rerun()
-                    else:
-                        st.error("❌ Erreur lors de la création de la session")
+                    # Sauvegarder dans localStorage si "Se souvenir de moi" est coché
+                    if remember_me:
+                        set_local_storage("frejus_session", session_token)
+                    
+                    st.success(message)
+                    st.balloons()
+                    st.rerun()
                 else:
                     st.error(message)
             else:
@@ -380,14 +1574,106 @@ if not st.session_state.authenticated:
 # Interface principale (suite du code identique...)
 # [Le reste du code reste le même que la version précédente]
 
-if 'conversations' not in st.session_state or st.session_state.get('reload_conversations', True):
-    conversations_data = get_user_conversations(st.session_state.user_id)
-    st.session_state.conversations = {conv['id']: conv['name'] for conv in conversations_data}
-    st.session_state.conversations_ids = {conv['name']: conv['id'] for conv in conversations_data}
-    if conversations_data:
-        st.session_state.current_conversation = conversations_data[0]['name']
-        st.session_state.current_conversation_id = conversations_data[0]['id']
-    st.session_state.reload_conversations = False
+# Conversations de l'utilisateur, indexées par id
+def conversation_store_needs_sync():
+    """Liste locale absente ou périmée : à relire depuis Supabase"""
+    store = st.session_state.get('conversation_store')
+    return (store is None or store['stale'] or store['user_id'] != st.session_state.user_id
+            or time.time() - store['synced_at'] > CONVERSATION_RESYNC_INTERVAL)
+
+def sync_conversation_store(rows, stats):
+    store = {
+        'user_id': st.session_state.user_id,
+        'conversations': {conv['id']: conv for conv in rows},
+        'stale': False,
+        'synced_at': time.time()
+    }
+    st.session_state.conversation_store = store
+    st.session_state.conversation_stats = stats
+    return store
+
+def mark_conversations_stale():
+    """Écriture refusée ou ligne introuvable : relire la liste au prochain rerun"""
+    if 'conversation_store' in st.session_state:
+        st.session_state.conversation_store['stale'] = True
+
+def on_new_conversation():
+    conversations = st.session_state.conversation_store['conversations']
+    new_conv = create_conversation(st.session_state.user_id, f"Conversation {len(conversations) + 1}")
+    if not new_conv:
+        mark_conversations_stale()
+        return
+    # Ligne renvoyée par l'insert : pas de relecture de la liste
+    conversations[new_conv['id']] = new_conv
+    st.session_state.conversation_stats[new_conv['id']] = {'message_count': 0, 'total_chars': 0, 'last_activity': None}
+    st.session_state.current_conversation_id = new_conv['id']
+
+def on_delete_conversation():
+    conversations = st.session_state.conversation_store['conversations']
+    conversation_id = st.session_state.current_conversation_id
+    if len(conversations) <= 1:
+        return
+    if not delete_conversation(conversation_id):
+        mark_conversations_stale()
+        return
+    conversations.pop(conversation_id, None)
+    st.session_state.conversation_stats.pop(conversation_id, None)
+    st.session_state.current_conversation_id = next(iter(conversations))
+    index = memory_store.get(st.session_state.user_id)
+    if index is not None:
+        index.remove_conversation(conversation_id)
+    # Les résultats de recherche pouvaient pointer vers la conversation supprimée
+    st.session_state.pop('search_results', None)
+
+def on_rename_conversation(conversation_id):
+    conversations = st.session_state.conversation_store['conversations']
+    new_name = st.session_state.get(f"rename_{conversation_id}", "").strip()
+    if not new_name or conversation_id not in conversations or new_name == conversations[conversation_id]['name']:
+        return
+    updated = rename_conversation(conversation_id, new_name)
+    if updated:
+        conversations[conversation_id] = dict(conversations[conversation_id], **updated)
+    else:
+        mark_conversations_stale()
+
+def on_select_conversation():
+    st.session_state.current_conversation_id = st.session_state.conversation_select
+
+class PageState:
+    """Données lues au début du rerun, partagées par la sidebar et le chat"""
+    
+    def __init__(self, conversations, conversation_id, messages):
+        self.conversations = conversations
+        self.conversation_id = conversation_id
+        self.messages = messages
+        self.stats = st.session_state.conversation_stats.get(conversation_id, {})
+        self.message_entry = st.session_state.message_cache[conversation_id]
+
+def load_page_state():
+    """Lancer ensemble les lectures indépendantes du rerun : sa durée est celle de la plus lente"""
+    user_id = st.session_state.user_id
+    conversation_id = st.session_state.get('current_conversation_id')
+    reads = {}
+    if conversation_store_needs_sync():
+        reads['conversations'] = (get_user_conversations, user_id)
+        reads['stats'] = (get_conversation_stats, user_id)
+    # Conversation active déjà connue : ses messages sont lus en même temps que la liste
+    message_read = plan_message_read(conversation_id) if conversation_id is not None else None
+    if message_read:
+        reads['messages'] = message_read
+    
+    with trace_span("page.load", reads=len(reads)):
+        results = run_concurrently(reads)
+    if 'conversations' in results:
+        sync_conversation_store(results['conversations'], results['stats'])
+    conversations = st.session_state.conversation_store['conversations']
+    if conversations and conversation_id not in conversations:
+        # Conversation supprimée ailleurs (ou première visite) : lecture spéculative inutilisable
+        conversation_id = st.session_state.current_conversation_id = next(iter(conversations))
+        results.pop('messages', None)
+    return PageState(conversations, conversation_id, get_cached_messages(conversation_id, results.get('messages')))
+
+page = load_page_state()
 
 # En-tête
 col1, col2, col3 = st.columns([1, 4, 1])
@@ -409,11 +1695,153 @@ with col3:
         st.session_state.user_id = None
         st.session_state.session_token = None
         st.session_state.storage_checked = False
+        st.session_state.pop('conversation_store', None)
+        # Export préparé et points de reprise d'import appartiennent au compte qui se déconnecte
+        st.session_state.pop('export_file', None)
+        st.session_state.pop('import_states', None)
+        # Résultats de recherche : noms et extraits des conversations de ce compte
+        st.session_state.pop('search_results', None)
+        st.session_state.pop('search_target', None)
+        invalidate_message_cache()
         
         st.success("✅ Déconnexion réussie")
         st.rerun()
 
+def render_debug_panel():
+    """Panneau d'administration : appels du dernier rerun et agrégats du processus"""
+    with st.expander("🛠️ Debug"):
+        last_rerun = st.session_state.get('last_rerun_trace') or []
+        st.markdown(f"**Dernier rerun** : {len(last_rerun)} appel(s), {sum(span['duration'] for span in last_rerun) * 1000:.0f} ms")
+        st.dataframe(
+            [
+                {
+                    'opération': span['operation'],
+                    'ms': round(span['duration'] * 1000, 1),
+                    'lignes': span.get('rows'),
+                    'octets': span.get('bytes'),
+                    'modèle': span.get('model'),
+                    'tokens': (span.get('prompt_tokens') or 0) + (span.get('completion_tokens') or 0) or None,
+                    'erreur': span.get('error')
+                }
+                for span in last_rerun
+            ],
+            use_container_width=True,
+            hide_index=True
+        )
+        
+        operations, _, reruns = trace_registry.snapshot()
+        admission = admission_controller.snapshot()
+        st.markdown(
+            f"**Processus** : {reruns} rerun(s) · Groq : {admission['active']}/{ADMISSION_MAX_CONCURRENT} "
+            f"requête(s) en cours, {admission['waiting']} en attente"
+        )
+        st.dataframe(
+            [
+                {
+                    'opération': name,
+                    'appels': stats['count'],
+                    'moy. ms': round(stats['duration'] / stats['count'] * 1000, 1),
+                    'max ms': round(stats['max'] * 1000, 1),
+                    'erreurs': stats['errors'],
+                    'octets': stats['bytes']
+                }
+                for name, stats in sorted(operations.items())
+            ],
+            use_container_width=True,
+            hide_index=True
+        )
+        st.download_button("📈 Métriques Prometheus", trace_registry.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+
+def render_backup_panel():
+    """Export / import JSONL compressé des conversations (voir conversation_io.py)"""
+    with st.expander("📦 Export / import"):
+        if st.button("Préparer l'export", use_container_width=True):
+            buffer = io.BytesIO()
+            try:
+                with gzip.open(buffer, "wt", encoding="utf-8") as output:
+                    count = conversation_io.export_conversations(supabase, st.session_state.user_id, output)
+                st.session_state.export_file = {'user_id': st.session_state.user_id, 'data': buffer.getvalue(), 'count': count}
+            except Exception as e:
+                st.error(f"Erreur export: {str(e)}")
+        export_file = st.session_state.get('export_file')
+        if export_file and export_file['user_id'] == st.session_state.user_id:
+            # Fichier libéré une fois téléchargé : pas de gzip gardé en mémoire de session
+            st.download_button(
+                f"⬇️ Télécharger ({export_file['count']} messages)",
+                export_file['data'],
+                file_name=f"frejus_{st.session_state.username}.jsonl.gz",
+                mime="application/gzip",
+                on_click=lambda: st.session_state.pop('export_file', None),
+                use_container_width=True
+            )
+        
+        uploaded = st.file_uploader("Importer un export", type=["jsonl", "gz"])
+        if uploaded and st.button("Importer", use_container_width=True):
+            # Point de reprise par utilisateur et par contenu : relancer l'import repart de la dernière ligne validée
+            file_key = (st.session_state.user_id, hashlib.sha256(uploaded.getbuffer()).hexdigest())
+            state = st.session_state.setdefault('import_states', {}).setdefault(file_key, {})
+            if state.get('done'):
+                st.info("Ce fichier a déjà été importé")
+                return
+            progress_bar = st.progress(0.0)
+            source = gzip.open(uploaded, "rt", encoding="utf-8") if uploaded.name.endswith(".gz") else io.TextIOWrapper(uploaded, encoding="utf-8")
+            try:
+                conversation_io.import_conversations(
+                    supabase,
+                    st.session_state.user_id,
+                    source,
+                    state,
+                    progress=lambda current: progress_bar.progress(
+                        min(uploaded.tell() / max(uploaded.size, 1), 1.0),
+                        text=f"{current['messages']} messages importés"
+                    )
+                )
+                st.success(f"✅ {state['messages']} messages importés dans {len(state['conversations'])} conversation(s)")
+            except Exception as e:
+                st.error(f"Import interrompu après la ligne {state.get('line', 0)} : {str(e)}. Relancez pour reprendre.")
+            finally:
+                mark_conversations_stale()
+
 # Sidebar (identique...)
+def open_search_result(hit):
+    """Ouvrir la conversation d'un résultat de recherche, positionnée sur le message trouvé"""
+    st.session_state.current_conversation_id = hit['conversation_id']
+    st.session_state.search_target = hit
+
+def render_search():
+    """Recherche dans toutes les conversations ; les résultats sont gardés tant que la requête ne change pas"""
+    query = st.text_input(
+        "Rechercher",
+        key="search_query",
+        placeholder="🔍 Rechercher dans mes conversations",
+        label_visibility="collapsed"
+    ).strip()
+    if len(query) < SEARCH_MIN_LENGTH:
+        return
+    
+    cached = st.session_state.get('search_results')
+    if not cached or cached['query'] != query:
+        cached = {'query': query, 'results': search_messages(
+            st.session_state.user_id,
+            query,
+            {conversation_id: conv['name'] for conversation_id, conv in page.conversations.items()}
+        )}
+        st.session_state.search_results = cached
+    
+    if not cached['results']:
+        st.caption("Aucun résultat")
+        return
+    for hit in cached['results']:
+        icon = "👤" if hit['role'] == "user" else "🧠"
+        st.button(
+            f"{icon} {hit['conversation_name']} · {hit['created_at'][:10]}",
+            key=f"search_hit_{hit['message_id']}",
+            on_click=open_search_result,
+            args=(hit,),
+            use_container_width=True
+        )
+        st.caption(hit['snippet'])
+
 with st.sidebar:
     st.header("⚙️ Configuration")
     st.success("✅ **Connecté** : Session active")
@@ -428,80 +1856,255 @@ with st.sidebar:
     )
     
     if model_category == "💬 Conversation générale":
-        model = st.selectbox("Modèle IA", ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768", "gemma2-9b-it"])
+        model_options = ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768", "gemma2-9b-it"]
         st.session_state.code_mode = False
         st.session_state.design_mode = False
     elif model_category == "💻 Codage expert":
-        model = st.selectbox("Modèle IA", ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"])
+        model_options = ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"]
         st.session_state.code_mode = True
         st.session_state.design_mode = False
-        st.info("🔧 Mode codage actif")
     else:
-        model = st.selectbox("Modèle IA", ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"])
+        model_options = ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"]
         st.session_state.design_mode = True
         st.session_state.code_mode = False
+    
+    model = st.selectbox(
+        "Modèle IA",
+        [AUTO_MODEL] + model_options,
+        format_func=lambda name: "🤖 Auto (modèle le plus rapide adapté)" if name == AUTO_MODEL else name
+    )
+    if st.session_state.code_mode:
+        st.info("🔧 Mode codage actif")
+    elif st.session_state.design_mode:
         st.success("🎨 Mode design actif")
     
+    st.toggle("⚡ Réponse en streaming", value=True, key="streaming")
+    st.toggle(
+        "🏁 Requête de secours si Groq tarde",
+        value=False,
+        key="hedging",
+        help="Relance la question (modèle de repli ou même modèle) quand le premier mot tarde ; la réponse la plus rapide est gardée."
+    )
+    st.toggle(
+        "🧠 Mémoire entre conversations",
+        value=False,
+        key="memory",
+        help="Envoie au modèle les derniers échanges et les passages de vos conversations les plus proches de la question, plutôt que tout l'historique."
+    )
+    if st.session_state.get("memory"):
+        index = memory_store.get(st.session_state.user_id)
+        if index is not None:
+            st.caption(f"🧠 {len(index)} messages indexés")
+    
     st.markdown("---")
     st.markdown("### 💬 Mes conversations")
+    render_search()
     
-    if st.session_state.conversations:
-        conversation_names = list(st.session_state.conversations.values())
-        selected_conv = st.selectbox("Conversation active", conversation_names, index=conversation_names.index(st.session_state.current_conversation), label_visibility="collapsed")
-        
-        if selected_conv != st.session_state.current_conversation:
-            st.session_state.current_conversation = selected_conv
-            st.session_state.current_conversation_id = st.session_state.conversations_ids[selected_conv]
-            st.rerun()
+    # Actions en callbacks : appliquées avant le rerun, une seule écriture et pas de rerun supplémentaire
+    current_id = page.conversation_id
+    conversations = page.conversations
+    if conversations:
+        if st.session_state.get('conversation_select') != current_id:
+            st.session_state.conversation_select = current_id
+        # Sélection par id : deux conversations peuvent porter le même nom
+        st.selectbox(
+            "Conversation active",
+            list(conversations),
+            format_func=lambda conversation_id: conversations[conversation_id]['name'],
+            key="conversation_select",
+            on_change=on_select_conversation,
+            label_visibility="collapsed"
+        )
     
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("➕ Nouvelle", use_container_width=True):
-            conv_count = len(st.session_state.conversations) + 1
-            new_conv = create_conversation(st.session_state.user_id, f"Conversation {conv_count}")
-            if new_conv:
-                st.session_state.reload_conversations = True
-                st.rerun()
+        st.button("➕ Nouvelle", use_container_width=True, on_click=on_new_conversation)
     
     with col2:
-        if st.button("🗑️ Supprimer", use_container_width=True):
-            if len(st.session_state.conversations) > 1:
-                delete_conversation(st.session_state.current_conversation_id)
-                st.session_state.reload_conversations = True
-                st.rerun()
-            else:
-                st.error("Gardez au moins 1 conversation")
+        st.button(
+            "🗑️ Supprimer",
+            use_container_width=True,
+            on_click=on_delete_conversation,
+            disabled=len(conversations) <= 1,
+            help="Gardez au moins 1 conversation" if len(conversations) <= 1 else None
+        )
     
-    new_name = st.text_input("Renommer", value=st.session_state.current_conversation, key="rename")
-    if new_name != st.session_state.current_conversation and new_name.strip():
-        rename_conversation(st.session_state.current_conversation_id, new_name)
-        st.session_state.reload_conversations = True
-        st.rerun()
+    if current_id in conversations:
+        # Renommage à la validation du formulaire (Entrée ou bouton), pas à chaque frappe
+        with st.form(f"rename_form_{current_id}", border=False):
+            st.text_input("Renommer", value=conversations[current_id]['name'], key=f"rename_{current_id}")
+            st.form_submit_button("✏️ Renommer", on_click=on_rename_conversation, args=(current_id,))
+    
+    render_backup_panel()
     
     st.markdown("---")
-    msg_count = len(get_conversation_messages(st.session_state.current_conversation_id))
-    st.metric("Messages", msg_count)
-    st.metric("Conversations", len(st.session_state.conversations))
+    current_stats = page.stats
+    st.metric("Messages", current_stats.get('message_count', len(page.messages)))
+    st.metric("Conversations", len(conversations))
+    if response_cache is not None:
+        cache_stats = response_cache.stats
+        cache_hits = cache_stats['memory_hits'] + cache_stats['disk_hits']
+        cache_lookups = cache_hits + cache_stats['misses']
+        if cache_lookups:
+            st.caption(f"🗃️ Cache des réponses : {cache_hits}/{cache_lookups} ({100 * cache_hits // cache_lookups} %)")
+    if current_stats.get('last_activity'):
+        st.caption(f"🕒 Dernière activité : {current_stats['last_activity'][:16].replace('T', ' ')}")
+    
+    if TRACE_ENABLED and st.session_state.username in ADMIN_USERS:
+        render_debug_panel()
 
 # Fonctions utilitaires
-def render_html_if_present(response_text):
-    html_pattern = r'```html\n(.*?)\n```'
-    html_matches = re.findall(html_pattern, response_text, re.DOTALL)
-    
-    if html_matches:
-        for i, html_code in enumerate(html_matches):
-            st.markdown(response_text.split('```html')[0])
-            if st.button(f"👁️ Aperçu", key=f"render_{i}_{hash(html_code)}", type="primary"):
-                components.html(html_code, height=600, scrolling=True)
-            with st.expander(f"📝 Code"):
-                st.code(html_code, language='html')
-        return True
-    return False
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
 
-def call_groq_api(messages, model, code_mode=False, design_mode=False):
-    url = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+HTML_BLOCK_PATTERN = re.compile(r'```html\n(.*?)\n```', re.DOTALL)
+
+@functools.lru_cache(maxsize=1024)
+def parse_html_segments(content):
+    """Découper une réponse en segments texte / HTML (mémoïsé : une seule analyse par contenu)"""
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    if '```html' not in content:
+        return digest, ()
+    
+    segments = []
+    position = 0
+    for match in HTML_BLOCK_PATTERN.finditer(content):
+        text = content[position:match.start()].strip()
+        if text:
+            segments.append(('text', text))
+        segments.append(('html', match.group(1)))
+        position = match.end()
+    if not any(kind == 'html' for kind, _ in segments):
+        return digest, ()
+    text = content[position:].strip()
+    if text:
+        segments.append(('text', text))
+    return digest, tuple(segments)
+
+def render_html_if_present(response_text, message_key="live"):
+    digest, segments = parse_html_segments(response_text)
+    if not segments:
+        return False
+    
+    block = 0
+    for kind, value in segments:
+        if kind == 'text':
+            st.markdown(value)
+            continue
+        # Clé stable (identifiant du message + empreinte du contenu) : l'aperçu reste ouvert entre les reruns
+        if st.toggle("👁️ Aperçu", key=f"preview_{message_key}_{digest[:12]}_{block}"):
+            components.html(value, height=600, scrolling=True)
+        with st.expander("📝 Code"):
+            st.code(value, language='html')
+        block += 1
+    return True
+
+def encode_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def prepare_image(data):
+    """Décoder une image envoyée, la réduire à ATTACHMENT_MAX_SIDE et la recompresser en JPEG borné"""
+    image = Image.open(io.BytesIO(data))
+    # Seul l'en-tête est lu à ce stade : refuser les dimensions démesurées avant de décoder
+    if image.width * image.height > ATTACHMENT_MAX_PIXELS:
+        raise ValueError("image trop grande")
+    # JPEG : décodage directement à une résolution réduite (mémoire bornée pour les photos de téléphone)
+    image.draft("RGB", (ATTACHMENT_MAX_SIDE, ATTACHMENT_MAX_SIDE))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Transparence aplatie sur fond blanc (JPEG n'a pas de canal alpha)
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.thumbnail((ATTACHMENT_MAX_SIDE, ATTACHMENT_MAX_SIDE), Image.LANCZOS)
     
+    quality = ATTACHMENT_JPEG_QUALITY
+    encoded = encode_jpeg(image, quality)
+    while len(encoded) > ATTACHMENT_MAX_BYTES:
+        if quality > 55:
+            quality -= 15
+        else:
+            image.thumbnail((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+        encoded = encode_jpeg(image, quality)
+    
+    return {
+        'sha256': hashlib.sha256(encoded).hexdigest(),
+        'mime_type': "image/jpeg",
+        'width': image.width,
+        'height': image.height,
+        'data': encoded
+    }
+
+def make_thumbnail(data):
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+    image = image.convert("RGB")
+    image.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.LANCZOS)
+    return encode_jpeg(image, 80)
+
+@st.cache_data(max_entries=THUMBNAIL_CACHE_ENTRIES, show_spinner=False)
+def get_thumbnail(sha256):
+    """Miniature d'une image jointe, en cache par empreinte : les reruns ne redécodent rien"""
+    data = get_attachment_data(sha256)
+    if data is None:
+        # Exception plutôt que None : un échec n'est pas mis en cache
+        raise LookupError(sha256)
+    return make_thumbnail(data)
+
+def render_attachments(attachments):
+    columns = st.columns(min(len(attachments), ATTACHMENT_MAX_FILES))
+    for position, image in enumerate(attachments):
+        with columns[position % len(columns)]:
+            try:
+                st.image(get_thumbnail(image['sha256']), width=THUMBNAIL_SIDE // 2)
+            except LookupError:
+                st.caption("🖼️ Image indisponible")
+
+def prepare_attachments(files):
+    """Images du message courant, préparées ; les fichiers refusés sont signalés"""
+    attachments = []
+    for uploaded in files[:ATTACHMENT_MAX_FILES]:
+        if uploaded.size > ATTACHMENT_MAX_UPLOAD_BYTES:
+            st.warning(f"⚠️ {uploaded.name} : fichier trop volumineux")
+            continue
+        try:
+            attachments.append(prepare_image(uploaded.getvalue()))
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            st.warning(f"⚠️ {uploaded.name} ignorée : {str(e)}")
+    if len(files) > ATTACHMENT_MAX_FILES:
+        st.warning(f"⚠️ {ATTACHMENT_MAX_FILES} images au maximum par message")
+    return attachments
+
+def with_images(message, attachments):
+    """Message utilisateur au format multimodal (texte + images en data URL base64)"""
+    return {
+        "role": message["role"],
+        "content": [{"type": "text", "text": message["content"]}] + [
+            {"type": "image_url", "image_url": {"url": f"data:{image['mime_type']};base64,{base64.b64encode(image['data']).decode('ascii')}"}}
+            for image in attachments
+        ]
+    }
+
+class GroqAPIError(Exception):
+    """Erreur lors d'un appel à l'API Groq"""
+    
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def get_temperature(code_mode=False, design_mode=False):
+    return 0.3 if code_mode else (0.8 if design_mode else 0.7)
+
+def get_max_tokens(code_mode=False, design_mode=False):
+    return 4096 if (code_mode or design_mode) else 2048
+
+def build_groq_payload(messages, model, code_mode=False, design_mode=False, stream=False):
+    """Construire le corps de requête Groq (prompt système + historique)"""
     clean_messages = []
     
     if code_mode:
@@ -515,55 +2118,769 @@ def call_groq_api(messages, model, code_mode=False, design_mode=False):
     data = {
         "model": model,
         "messages": clean_messages,
-        "temperature": 0.3 if code_mode else (0.8 if design_mode else 0.7),
-        "max_tokens": 4096 if (code_mode or design_mode) else 2048
+        "temperature": get_temperature(code_mode, design_mode),
+        "max_tokens": get_max_tokens(code_mode, design_mode)
     }
+    if stream:
+        data["stream"] = True
+    return data
+
+RATE_LIMIT_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+def parse_rate_limit_duration(value):
+    """Convertir une durée Groq ("2m59.56s", "7.66s", "120ms") ou un nombre de secondes"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = RATE_LIMIT_DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def get_retry_delay(response, attempt):
+    """Délai avant la prochaine tentative : en-têtes de Groq, sinon backoff exponentiel avec jitter"""
+    backoff = random.uniform(0, min(GROQ_BACKOFF_MAX, GROQ_BACKOFF_BASE * 2 ** attempt))
+    if response is None:
+        return backoff
     
+    delay = parse_rate_limit_duration(response.headers.get("retry-after"))
+    if delay is None and response.status_code == 429:
+        # Attendre la réinitialisation du quota épuisé (requêtes et/ou tokens)
+        resets = []
+        for kind in ("requests", "tokens"):
+            if response.headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+                resets.append(parse_rate_limit_duration(response.headers.get(f"x-ratelimit-reset-{kind}")))
+        resets = [reset for reset in resets if reset is not None]
+        delay = max(resets) if resets else None
+    return max(delay, backoff) if delay is not None else backoff
+
+def get_error_message(response):
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        return result["choices"][0]["message"]["content"] if "choices" in result else "❌ Erreur"
-    except Exception as e:
-        return f"❌ Erreur: {str(e)}"
+        error = response.json().get("error", {})
+        return error.get("message", response.reason) if isinstance(error, dict) else str(error)
+    except ValueError:
+        return f"{response.status_code} {response.reason}"
+
+def groq_post(payload, stream=False):
+    """POST vers Groq avec reprises sur 429/5xx et erreurs réseau (avant le premier octet de réponse)"""
+    last_error = None
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        response = None
+        try:
+            response = groq_session.post(
+                GROQ_API_URL,
+                json=payload,
+                stream=stream,
+                timeout=(GROQ_CONNECT_TIMEOUT, GROQ_READ_TIMEOUT)
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            last_error = f"Groq injoignable: {str(e)}"
+            status_code = None
+        else:
+            if response.status_code < 400:
+                return response
+            last_error = get_error_message(response)
+            status_code = response.status_code
+            if response.status_code != 429 and response.status_code < 500:
+                response.close()
+                raise GroqAPIError(last_error, status_code)
+        
+        delay = get_retry_delay(response, attempt)
+        if response is not None:
+            response.close()
+        if attempt == GROQ_MAX_RETRIES:
+            break
+        if delay > GROQ_MAX_RETRY_WAIT:
+            raise GroqAPIError(f"Limite de requêtes atteinte, réessayez dans {int(delay)} s ({last_error})", status_code, delay)
+        time.sleep(delay)
+    
+    raise GroqAPIError(last_error, status_code, delay)
+
+def record_groq_usage(span, usage, response_bytes=None):
+    """Reporter le champ usage de Groq (tokens du prompt et de la réponse) dans un span"""
+    if usage:
+        span['prompt_tokens'] = usage.get('prompt_tokens')
+        span['completion_tokens'] = usage.get('completion_tokens')
+    if response_bytes is not None:
+        span['bytes'] = response_bytes
+
+def call_groq_api(messages, model, code_mode=False, design_mode=False):
+    """Réponse complète (sans streaming) ; lève GroqAPIError en cas d'échec"""
+    data = build_groq_payload(messages, model, code_mode, design_mode)
+    with trace_span("groq.completion", model=model) as span:
+        started = time.perf_counter()
+        response = groq_post(data)
+        try:
+            result = response.json()
+            record_groq_usage(span, result.get("usage"), len(response.content))
+            model_router.record_success(model, completion_tokens=span.get('completion_tokens'), duration=time.perf_counter() - started)
+            return result["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError) as e:
+            raise GroqAPIError(f"Réponse invalide: {str(e)}") from e
+
+def stream_groq_api(messages, model, code_mode=False, design_mode=False, on_response=None):
+    """Générer la réponse morceau par morceau via le flux SSE de Groq.
+    on_response(response) reçoit la réponse HTTP dès les en-têtes (pour pouvoir la fermer depuis un autre thread)."""
+    data = build_groq_payload(messages, model, code_mode, design_mode, stream=True)
+    with trace_span("groq.stream", model=model) as span:
+        started = time.perf_counter()
+        response = groq_post(data, stream=True)
+        if on_response:
+            on_response(response)
+        received = 0
+        chunk_count = 0
+        
+        with response:
+            try:
+                # Décoder ligne par ligne en UTF-8 : le flux SSE n'annonce pas toujours son charset
+                for raw_line in response.iter_lines():
+                    received += len(raw_line)
+                    line = raw_line.decode('utf-8', errors='replace').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[len('data:'):].strip()
+                    if payload == '[DONE]':
+                        span['bytes'] = received
+                        model_router.record_success(
+                            model,
+                            span.get('ttft'),
+                            span.get('completion_tokens') or chunk_count,
+                            time.perf_counter() - started
+                        )
+                        return
+                    try:
+                        chunk = json.loads(payload)
+                    except ValueError:
+                        continue
+                    if chunk.get('error'):
+                        error = chunk['error']
+                        raise GroqAPIError(error.get('message', str(error)) if isinstance(error, dict) else str(error))
+                    # Groq envoie l'usage dans le dernier morceau (x_groq.usage, ou usage au format OpenAI)
+                    record_groq_usage(span, chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage'))
+                    for choice in chunk.get('choices', []):
+                        content = (choice.get('delta') or {}).get('content')
+                        if content:
+                            if 'ttft' not in span:
+                                span['ttft'] = time.perf_counter() - started
+                            chunk_count += 1
+                            yield content
+            except requests.RequestException as e:
+                raise GroqAPIError(f"Flux interrompu: {str(e)}") from e
+        
+        # Le serveur a fermé la connexion sans envoyer [DONE]
+        raise GroqAPIError("Flux interrompu avant la fin de la réponse")
+
+def abort_response(response):
+    """Interrompre depuis un autre thread une réponse en cours de lecture.
+    response.close() attendrait la fin de la lecture bloquée : on coupe la socket."""
+    sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    if sock is None:
+        response.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class HedgedStream:
+    """Flux Groq doublé si le premier token tarde : la première requête qui répond est
+    gardée, l'autre est fermée. Itérable comme stream_groq_api ; model indique le gagnant."""
+    
+    def __init__(self, messages, model, hedge_model, code_mode=False, design_mode=False, user_id=None, prompt_tokens=0):
+        self.messages = messages
+        self.model = model
+        self.hedge_model = hedge_model
+        self.code_mode = code_mode
+        self.design_mode = design_mode
+        # La requête de secours passe aussi par l'admission (place et tokens de l'utilisateur)
+        self.user_id = user_id
+        self.prompt_tokens = prompt_tokens
+        self.hedge_ticket = None
+        self.events = queue.Queue()
+        self.workers = []
+    
+    def _start(self, model):
+        """Lire un flux dans un thread ; ses morceaux arrivent dans self.events"""
+        index = len(self.workers)
+        cancel = threading.Event()
+        worker = {'model': model, 'cancel': cancel, 'started': time.perf_counter(), 'response': None, 'finished': False}
+        self.workers.append(worker)
+        
+        def keep_response(response):
+            worker['response'] = response
+            # Annulé pendant l'attente des en-têtes
+            if cancel.is_set():
+                abort_response(response)
+        
+        def run():
+            chunks = stream_groq_api(self.messages, model, self.code_mode, self.design_mode, on_response=keep_response)
+            try:
+                for content in chunks:
+                    if cancel.is_set():
+                        return
+                    self.events.put((index, 'chunk', content))
+                # Flux terminé : sa connexion retourne au pool, elle ne doit plus être coupée
+                worker['finished'] = True
+                self.events.put((index, 'done', None))
+            except Exception as e:
+                # Erreur provoquée par la fermeture du perdant : rien à signaler
+                if not cancel.is_set():
+                    self.events.put((index, 'error', e if isinstance(e, GroqAPIError) else GroqAPIError(str(e))))
+            finally:
+                chunks.close()
+        
+        # Contexte copié : les spans du thread restent rattachés au rerun en cours
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), daemon=True).start()
+    
+    def _cancel(self, worker):
+        """Arrêter une requête : la connexion est fermée même si aucun morceau n'est arrivé"""
+        worker['cancel'].set()
+        response = worker['response']
+        if response is not None and not worker['finished']:
+            abort_response(response)
+    
+    def __iter__(self):
+        model_router.record_request()
+        self._start(self.model)
+        try:
+            try:
+                event = self.events.get(timeout=model_router.hedge_delay(self.model))
+            except queue.Empty:
+                event = None
+                self.hedge_ticket = admission_controller.try_admit(
+                    self.user_id, self.prompt_tokens + get_max_tokens(self.code_mode, self.design_mode)
+                )
+                if self.hedge_ticket and model_router.allow_hedge():
+                    self._start(self.hedge_model)
+                elif self.hedge_ticket:
+                    admission_controller.release(self.hedge_ticket, 0)
+                    self.hedge_ticket = None
+            
+            # Attendre le premier morceau de l'une des requêtes
+            failed = []
+            while True:
+                index, kind, value = event or self.events.get()
+                event = None
+                if kind != 'error':
+                    break
+                if index > 0:
+                    model_router.record_failure(self.workers[index]['model'], value)
+                failed.append((index, value))
+                if len(failed) == len(self.workers):
+                    # Erreur de la requête principale en priorité (comptée par l'appelant)
+                    raise min(failed, key=lambda item: item[0])[1]
+            
+            winner = index
+            self.model = self.workers[winner]['model']
+            for position, worker in enumerate(self.workers):
+                if position != winner and not any(item[0] == position for item in failed):
+                    self._cancel(worker)
+                    model_router.record_slow_start(worker['model'], time.perf_counter() - worker['started'])
+            
+            while kind != 'done':
+                if kind == 'error':
+                    raise value
+                yield value
+                index, kind, value = self.events.get()
+                while index != winner:
+                    index, kind, value = self.events.get()
+        finally:
+            # Consommateur interrompu (rerun) ou réponse terminée : plus rien à lire
+            for worker in self.workers:
+                self._cancel(worker)
+            if self.hedge_ticket:
+                # Une seule réponse produite (comptée sur le ticket du tour) : le doublon ne coûte que son prompt
+                admission_controller.release(self.hedge_ticket, self.prompt_tokens)
+
+def render_assistant_message(content, message_key="live"):
+    """Afficher une réponse de l'assistant (aperçu HTML en mode design)"""
+    if st.session_state.get("design_mode") and render_html_if_present(content, message_key):
+        return
+    st.markdown(content)
+
+def stream_assistant_response(chunks):
+    """Afficher la réponse au fil de l'eau ; renvoie (texte final, réponse complète).
+    Lève GroqAPIError si aucun token n'a été reçu."""
+    placeholder = st.empty()
+    chunks = iter(chunks)
+    response = ""
+    interrupted = False
+    
+    try:
+        # Le spinner ne dure que jusqu'au premier token
+        with st.spinner("🤔 Frejus réfléchit..."):
+            response = next(chunks, "")
+        last_render = 0.0
+        for chunk in chunks:
+            response += chunk
+            # Limiter le nombre de mises à jour envoyées au navigateur
+            if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                placeholder.markdown(response + "▌")
+                last_render = time.monotonic()
+    except GroqAPIError:
+        if not response:
+            # Aucun token reçu : l'appelant peut réessayer avec un autre modèle
+            placeholder.empty()
+            raise
+        interrupted = True
+    
+    if not response:
+        placeholder.empty()
+        raise GroqAPIError("Réponse vide")
+    if interrupted:
+        response += "\n\n⚠️ *Réponse interrompue*"
+    
+    with placeholder.container():
+        render_assistant_message(response)
+    return response, not interrupted
+
+def response_cache_key(messages, model, code_mode=False, design_mode=False):
+    """Clé de cache (None si la réponse ne doit pas être mise en cache)"""
+    temperature = get_temperature(code_mode, design_mode)
+    if response_cache is None or temperature > RESPONSE_CACHE_MAX_TEMPERATURE:
+        return None
+    # Messages avec images : pas de mise en cache
+    if any(not isinstance(msg["content"], str) for msg in messages):
+        return None
+    # Seuls les blancs sans effet sur le sens sont normalisés (bords, fins de ligne) :
+    # l'indentation et la mise en ligne du code restent dans la clé
+    normalized = [[msg["role"], msg["content"].replace("\r\n", "\n").strip()] for msg in messages]
+    key_data = json.dumps([model, code_mode, design_mode, temperature, normalized], ensure_ascii=False)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+def estimate_prompt_tokens(messages):
+    """Tokens estimés du prompt, images comprises (coût forfaitaire)"""
+    tokens = 0
+    for msg in messages:
+        if isinstance(msg["content"], str):
+            tokens += estimate_message_tokens(msg)
+            continue
+        for part in msg["content"]:
+            tokens += estimate_tokens(part["text"]) if part["type"] == "text" else ADMISSION_IMAGE_TOKENS
+        tokens += 4
+    return tokens
+
+def admit_groq_request(cost):
+    """Attendre une place pour une requête Groq en affichant la position dans la file.
+    Renvoie le ticket à libérer avec admission_controller.release, ou None après ADMISSION_MAX_WAIT."""
+    ticket = admission_controller.enqueue(st.session_state.user_id, cost)
+    if ticket['admitted']:
+        return ticket
+    placeholder = st.empty()
+    deadline = time.monotonic() + ADMISSION_MAX_WAIT
+    try:
+        while not admission_controller.wait(ticket, ADMISSION_POLL_INTERVAL):
+            if time.monotonic() >= deadline:
+                admission_controller.release(ticket, 0)
+                return None
+            status = admission_controller.status(ticket)
+            if status['throttled_for'] > 0:
+                placeholder.info(f"⏳ Quota personnel atteint : reprise dans ~{int(status['throttled_for']) + 1} s")
+            else:
+                placeholder.info(f"⏳ Serveur occupé : vous êtes n° {status['position']} dans la file d'attente")
+    except BaseException:
+        # Rerun ou arrêt pendant l'attente : ne pas garder la place
+        admission_controller.release(ticket, 0)
+        raise
+    finally:
+        placeholder.empty()
+    return ticket
+
+def get_assistant_response(messages, models, code_mode=False, design_mode=False):
+    """Afficher la réponse de l'assistant (cache, streaming ou appel bloquant).
+    Les modèles sont essayés dans l'ordre ; renvoie (réponse, modèle utilisé) ou (None, None)."""
+    last_error = None
+    ticket = None
+    prompt_tokens = estimate_prompt_tokens(messages)
+    used_tokens = prompt_tokens
+    try:
+        for position, model in enumerate(models):
+            cache_key = response_cache_key(messages, model, code_mode, design_mode)
+            if cache_key:
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    render_assistant_message(cached)
+                    return cached, model
+            
+            # Une seule admission par tour, conservée pour les modèles de repli
+            if ticket is None:
+                ticket = admit_groq_request(prompt_tokens + get_max_tokens(code_mode, design_mode))
+                if ticket is None:
+                    st.error("❌ Trop de demandes en cours : réessayez dans un instant.")
+                    return None, None
+            
+            hedged = None
+            if st.session_state.get("hedging", False):
+                # Secours vers le modèle de repli suivant, sinon vers le même modèle
+                hedge_model = models[position + 1] if position + 1 < len(models) else model
+                hedged = HedgedStream(
+                    messages, model, hedge_model, code_mode, design_mode, st.session_state.user_id, prompt_tokens
+                )
+            try:
+                if st.session_state.get("streaming", True):
+                    chunks = hedged if hedged else stream_groq_api(messages, model, code_mode, design_mode)
+                    response, complete = stream_assistant_response(chunks)
+                else:
+                    with st.spinner("🤔 Frejus réfléchit..."):
+                        # Le délai de secours porte sur le premier token : flux lu en entier
+                        response = "".join(hedged) if hedged else call_groq_api(messages, model, code_mode, design_mode)
+                    render_assistant_message(response)
+                    complete = True
+            except GroqAPIError as e:
+                model_router.record_failure(model, e)
+                last_error = e
+                continue
+            
+            used_tokens = prompt_tokens + estimate_tokens(response)
+            if hedged:
+                model = hedged.model
+                cache_key = response_cache_key(messages, model, code_mode, design_mode)
+            if cache_key and complete:
+                response_cache.put(cache_key, response)
+            return response, model
+    finally:
+        if ticket is not None:
+            # Tokens de réponse réservés mais non produits rendus au seau de l'utilisateur
+            admission_controller.release(ticket, used_tokens)
+    
+    # Les erreurs ne sont pas enregistrées comme réponse de l'assistant
+    st.error(f"❌ Erreur: {str(last_error)}")
+    return None, None
+
+# Gestion de la fenêtre de contexte
+def estimate_tokens(text):
+    """Estimer le nombre de tokens sans tokenizer externe (~4 caractères par token pour les mots longs)"""
+    tokens = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        tokens += -(-len(piece) // 4) if piece[0].isalnum() or piece[0] == '_' else 1
+    return tokens
+
+def estimate_message_tokens(message):
+    # ~4 tokens de balisage par message dans le format chat
+    return estimate_tokens(message["content"]) + 4
+
+def get_context_budget(model, code_mode=False, design_mode=False):
+    """Budget de tokens du prompt : fenêtre du modèle moins la réponse attendue"""
+    max_tokens = get_max_tokens(code_mode, design_mode)
+    limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+    # Marge pour le prompt système et les approximations de l'estimation
+    return min(CONTEXT_PROMPT_BUDGET, limit - max_tokens - 256)
+
+def summarize_messages(previous_summary, messages):
+    """Intégrer des messages au résumé existant (appel Groq avec le modèle rapide)"""
+    transcript = "\n\n".join(f"{msg['role']}: {msg['content'][:4000]}" for msg in messages)
+    prompt = (
+        "Mets à jour le résumé de cette conversation en intégrant les nouveaux échanges. "
+        "Conserve les faits, décisions, préférences de l'utilisateur et extraits de code importants. "
+        "Réponds uniquement par le résumé, en français, de façon concise.\n\n"
+        f"Résumé actuel :\n{previous_summary or '(aucun)'}\n\nNouveaux échanges :\n{transcript}"
+    )
+    data = {
+        "model": SUMMARY_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "max_tokens": SUMMARY_MAX_TOKENS
+    }
+    with trace_span("groq.summary", model=SUMMARY_MODEL) as span:
+        response = groq_post(data)
+        try:
+            result = response.json()
+            record_groq_usage(span, result.get("usage"), len(response.content))
+            return result["choices"][0]["message"]["content"].strip()
+        except (ValueError, KeyError, IndexError) as e:
+            raise GroqAPIError(f"Réponse invalide: {str(e)}") from e
+
+# Mises à jour de résumé en cours (conversation_id -> Future), hors du chemin de la réponse
+@st.cache_resource
+def init_summary_jobs():
+    return {}
+
+summary_jobs = init_summary_jobs()
+
+# Résumés échoués (conversation_id -> [échecs consécutifs, instant de la prochaine tentative])
+@st.cache_resource
+def init_summary_failures():
+    return {}
+
+summary_failures = init_summary_failures()
+
+def get_cached_summary(conversation_id):
+    """Résumé de la conversation, chargé une seule fois par session puis remplacé par les mises à jour terminées"""
+    cache = st.session_state.setdefault('summary_cache', {})
+    job = summary_jobs.get(conversation_id)
+    if job is not None and job.done():
+        summary_jobs.pop(conversation_id, None)
+        if job.result():
+            cache[conversation_id] = job.result()
+            summary_failures.pop(conversation_id, None)
+        else:
+            failures = summary_failures.get(conversation_id, [0, 0])[0] + 1
+            delay = min(SUMMARY_RETRY_DELAY * 2 ** (failures - 1), SUMMARY_RETRY_MAX_DELAY)
+            summary_failures[conversation_id] = [failures, time.monotonic() + delay]
+    if conversation_id not in cache:
+        cache[conversation_id] = get_conversation_summary(conversation_id)
+    return cache[conversation_id]
+
+def fold_into_summary(conversation_id, summary, older, batch_budget):
+    """Intégrer les messages sortis de la fenêtre au résumé et le persister (thread d'arrière-plan).
+    Renvoie le nouveau résumé, None si Groq n'a pas répondu."""
+    summary_text = summary['summary'] if summary else None
+    try:
+        # Résumer par lots pour que chaque appel reste dans la fenêtre du modèle rapide
+        batch, batch_tokens = [], 0
+        for msg in older:
+            batch.append(msg)
+            batch_tokens += estimate_message_tokens(msg)
+            if batch_tokens >= batch_budget:
+                summary_text = summarize_messages(summary_text, batch)
+                batch, batch_tokens = [], 0
+        if batch:
+            summary_text = summarize_messages(summary_text, batch)
+    except GroqAPIError:
+        return None
+    
+    summary = {'summary': summary_text, 'summarized_until': older[-1]['created_at']}
+    save_conversation_summary(conversation_id, summary_text, summary['summarized_until'])
+    return summary
+
+def schedule_summary(conversation_id, summary, older, batch_budget):
+    """Mettre à jour le résumé en arrière-plan (une mise à jour à la fois par conversation,
+    pas avant la fin de l'attente après un échec)"""
+    job = summary_jobs.get(conversation_id)
+    if job is not None and not job.done():
+        return
+    failure = summary_failures.get(conversation_id)
+    if failure and time.monotonic() < failure[1]:
+        return
+    summary_jobs[conversation_id] = background_pool.submit(
+        contextvars.copy_context().run, fold_into_summary, conversation_id, summary, older, batch_budget
+    )
+
+def split_recent_messages(messages, budget):
+    """Position à partir de laquelle les derniers messages tiennent dans budget (le dernier est toujours gardé)"""
+    split = len(messages) - 1
+    used = estimate_message_tokens(messages[-1])
+    while split > 0:
+        cost = estimate_message_tokens(messages[split - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        split -= 1
+    return split
+
+def build_context_messages(conversation_id, prompt, model, code_mode=False, design_mode=False):
+    """Garder les derniers échanges tels quels et remplacer les plus anciens par le résumé glissant"""
+    budget = get_context_budget(model, code_mode, design_mode)
+    summary = get_cached_summary(conversation_id)
+    
+    # Seule la fenêtre affichée est en cache : compléter avec les messages pas encore résumés,
+    # sur un nombre de pages borné (sans résumé, tout l'historique serait relu)
+    load_messages_until(conversation_id, summary['summarized_until'] if summary else None, SUMMARY_MAX_LOAD_PAGES)
+    history = get_loaded_history(conversation_id) + [{"role": "user", "content": prompt}]
+    
+    # Messages pas encore couverts par le résumé (le prompt courant n'a pas de created_at)
+    pending = history
+    if summary:
+        summarized_until = parse_timestamp(summary['summarized_until'])
+        pending = [msg for msg in history if not msg.get('created_at') or parse_timestamp(msg['created_at']) > summarized_until]
+    
+    summary_tokens = estimate_tokens(summary['summary']) + 4 if summary else 0
+    if summary_tokens + sum(estimate_message_tokens(msg) for msg in pending) > budget:
+        # Garder la moitié du budget pour les échanges récents : le résumé n'est
+        # recalculé qu'une fois que cette marge est consommée, pas à chaque tour
+        split = split_recent_messages(pending, max(budget // 2 - SUMMARY_MAX_TOKENS, 0))
+        if split:
+            schedule_summary(conversation_id, summary, pending[:split], budget)
+        # Ce tour (et les suivants tant que le nouveau résumé manque) part avec le résumé
+        # actuel : ne retirer que ce qui dépasse le budget, pas ce qui est en cours de résumé
+        pending = pending[split_recent_messages(pending, max(budget - summary_tokens, 0)):]
+    
+    context = []
+    if summary:
+        context.append({"role": "system", "content": f"Résumé des échanges précédents de cette conversation :\n{summary['summary']}"})
+    context.extend({"role": msg["role"], "content": msg["content"]} for msg in pending)
+    return context
+
+def read_recent_messages(conversations, limit):
+    """Les limit messages indexables les plus récents de toutes les conversations, du plus ancien au plus récent.
+    Chaque conversation est lue par pages keyset du plus récent au plus ancien ; une conversation
+    n'est plus lue dès que ses messages restants sont tous plus anciens que les limit déjà retenus.
+    Lectures sur background_pool : elles ne retardent pas les reruns des autres utilisateurs."""
+    cursors = {conversation_id: None for conversation_id in conversations}
+    recent = []
+    while cursors:
+        reads = {
+            conversation_id: (get_history_page, conversation_id, before, MEMORY_BUILD_PAGE_SIZE)
+            for conversation_id, before in cursors.items()
+        }
+        for conversation_id, (page, has_more) in run_concurrently(reads, background_pool).items():
+            recent.extend(msg for msg in page if len(msg['content'].strip()) >= MEMORY_MIN_CHARS)
+            if has_more and page:
+                cursors[conversation_id] = (page[0]['created_at'], page[0]['id'])
+            else:
+                del cursors[conversation_id]
+        recent.sort(key=lambda msg: parse_timestamp(msg['created_at']))
+        del recent[:-limit]
+        if len(recent) == limit:
+            threshold = parse_timestamp(recent[0]['created_at'])
+            cursors = {
+                conversation_id: before for conversation_id, before in cursors.items()
+                if parse_timestamp(before[0]) > threshold
+            }
+    return recent
+
+def get_memory_index(user_id, conversations):
+    """Index de l'utilisateur, construit au premier usage à partir de son historique
+    (seuls les MEMORY_MAX_ENTRIES_PER_USER messages les plus récents sont indexés)"""
+    index = memory_store.get(user_id)
+    if index is None:
+        with st.spinner("🧠 Indexation de vos conversations..."):
+            index = memory_index.MemoryIndex(MEMORY_MAX_ENTRIES_PER_USER)
+            index_messages(index, read_recent_messages(conversations, MEMORY_MAX_ENTRIES_PER_USER))
+            # Messages encore en file d'écriture, absents de la base
+            for entry in st.session_state.get('message_cache', {}).values():
+                index_messages(index, entry['pending'])
+        memory_store.put(user_id, index)
+    return index
+
+def build_memory_context(conversation_id, prompt, model, code_mode=False, design_mode=False):
+    """Contexte avec mémoire : derniers échanges et extraits pertinents de toutes les conversations"""
+    budget = min(get_context_budget(model, code_mode, design_mode), MEMORY_CONTEXT_BUDGET)
+    history = get_loaded_history(conversation_id) + [{"role": "user", "content": prompt}]
+    recent = history[split_recent_messages(history, budget // 2):]
+    
+    conversations = st.session_state.conversation_store['conversations']
+    index = get_memory_index(st.session_state.user_id, conversations)
+    # Messages déjà présents dans le contexte : inutile de les retrouver
+    exclude = {memory_key(msg) for msg in recent if msg.get('created_at')}
+    hits = index.search(memory_index.embed(prompt), MEMORY_TOP_K, MEMORY_MIN_SCORE, exclude)
+    
+    snippets = []
+    remaining = budget - sum(estimate_message_tokens(msg) for msg in recent)
+    for hit in hits:
+        conversation = conversations.get(hit['conversation_id'])
+        if conversation is None:
+            # Conversation supprimée depuis un autre appareil
+            continue
+        speaker = "Utilisateur" if hit['role'] == "user" else "Assistant"
+        snippet = f"[{conversation['name']} · {hit['created_at'][:10]} · {speaker}] {hit['content']}"
+        cost = estimate_tokens(snippet)
+        if cost > remaining:
+            break
+        snippets.append(snippet)
+        remaining -= cost
+    
+    context = []
+    if snippets:
+        context.append({
+            "role": "system",
+            "content": "Extraits de conversations passées de l'utilisateur, à utiliser seulement s'ils aident à répondre :\n\n" + "\n\n".join(snippets)
+        })
+    context.extend({"role": msg["role"], "content": msg["content"]} for msg in recent)
+    return context
 
 # Afficher les messages
-messages = get_conversation_messages(st.session_state.current_conversation_id)
+failed_messages = message_writer.pop_failed(st.session_state.current_conversation_id)
+if failed_messages:
+    st.warning(f"⚠️ {len(failed_messages)} message(s) n'ont pas pu être enregistrés.")
+
+# Seuls les derniers messages sont rendus : le coût d'un rerun ne dépend pas de la longueur de la conversation
+message_entry = page.message_entry
+messages = page.messages
+
+# Résultat de recherche ouvert : charger l'historique jusqu'au message et l'inclure dans la fenêtre
+search_target = st.session_state.pop('search_target', None)
+if search_target and str(search_target['conversation_id']) == str(st.session_state.current_conversation_id):
+    load_messages_until(st.session_state.current_conversation_id, search_target['created_at'])
+    messages = get_loaded_history(st.session_state.current_conversation_id)
+    target_position = next(
+        (position for position, msg in enumerate(messages) if str(msg.get('id')) == str(search_target['message_id'])),
+        None
+    )
+    if target_position is not None:
+        message_entry['window'] = max(message_entry['window'], len(messages) - target_position)
+        st.session_state.highlighted_message_id = search_target['message_id']
+if len(messages) > message_entry['window'] or message_entry['has_more']:
+    if st.button("⬆️ Afficher les messages précédents", use_container_width=True):
+        if len(messages) - message_entry['window'] < CHAT_WINDOW_SIZE:
+            load_older_messages(st.session_state.current_conversation_id)
+        message_entry['window'] += CHAT_WINDOW_SIZE
+        st.rerun()
 
-for msg in messages:
+for msg in messages[-message_entry['window']:]:
     with st.chat_message(msg["role"]):
-        if msg["role"] == "assistant" and st.session_state.get("design_mode"):
-            if not render_html_if_present(msg["content"]):
-                st.markdown(msg["content"])
+        if msg.get("id") is not None and str(msg["id"]) == str(st.session_state.get('highlighted_message_id')):
+            st.caption("🔍 Résultat de la recherche")
+        if msg["role"] == "assistant":
+            render_assistant_message(msg["content"], msg.get("id") or msg["created_at"])
+            if msg.get("model"):
+                st.caption(f"🤖 {msg['model']}")
         else:
             st.markdown(msg["content"])
+            if msg.get("attachments"):
+                render_attachments(msg["attachments"])
 
 # Input utilisateur
-if prompt := st.chat_input("💬 Écrivez votre message..."):
-    save_message(st.session_state.current_conversation_id, "user", prompt)
-    
+if chat_value := st.chat_input("💬 Écrivez votre message...", accept_file="multiple", file_type=ATTACHMENT_TYPES):
+    prompt = chat_value.text
+    attachments = prepare_attachments(chat_value.files)
+    if not prompt and attachments:
+        prompt = "Décris cette image."
+    if not prompt:
+        # Images toutes refusées et aucun texte (avertissements déjà affichés) : rien à envoyer
+        st.stop()
     with st.chat_message("user"):
         st.markdown(prompt)
+        if attachments:
+            columns = st.columns(len(attachments))
+            for position, image in enumerate(attachments):
+                columns[position].image(make_thumbnail(image['data']), width=THUMBNAIL_SIDE // 2)
+    
+    code_mode = st.session_state.get("code_mode", False)
+    design_mode = st.session_state.get("design_mode", False)
+    if attachments:
+        # Seul le modèle vision accepte les images
+        if not save_attachments(st.session_state.user_id, attachments):
+            st.warning("⚠️ Images non enregistrées : elles n'apparaîtront pas dans l'historique")
+        models_to_try = [VISION_MODEL]
+    elif model == AUTO_MODEL:
+        ranked = model_router.rank(
+            model_options, estimate_tokens(prompt), get_max_tokens(code_mode, design_mode), code_mode, design_mode
+        )
+        # Replis limités aux modèles dont la fenêtre contient le contexte construit pour le premier
+        budget = get_context_budget(ranked[0], code_mode, design_mode)
+        models_to_try = [name for name in ranked if get_context_budget(name, code_mode, design_mode) >= budget]
+    else:
+        models_to_try = [model]
+    
+    build_context = build_memory_context if st.session_state.get("memory") else build_context_messages
+    messages_for_api = build_context(
+        st.session_state.current_conversation_id,
+        prompt,
+        models_to_try[0],
+        code_mode,
+        design_mode
+    )
+    if attachments:
+        # Images du tour courant seulement : la taille de la requête reste bornée
+        messages_for_api[-1] = with_images(messages_for_api[-1], attachments)
     
     with st.chat_message("assistant"):
-        with st.spinner("🤔 Frejus réfléchit..."):
-            messages_for_api = [{"role": m["role"], "content": m["content"]} for m in messages]
-            messages_for_api.append({"role": "user", "content": prompt})
-            
-            response = call_groq_api(
-                messages_for_api,
-                model,
-                st.session_state.get("code_mode", False),
-                st.session_state.get("design_mode", False)
-            )
-            
-            if st.session_state.get("design_mode") and not render_html_if_present(response):
-                st.markdown(response)
-            elif not st.session_state.get("design_mode"):
-                st.markdown(response)
+        response, used_model = get_assistant_response(messages_for_api, models_to_try, code_mode, design_mode)
+        if response is not None and (model == AUTO_MODEL or attachments):
+            st.caption(f"🤖 {used_model}")
     
-    save_message(st.session_state.current_conversation_id, "assistant", response)
-    st.rerun()
+    # Enregistrer le tour en un seul lot, une fois la réponse terminée
+    if response is not None:
+        queue_messages(st.session_state.current_conversation_id, [("user", prompt), ("assistant", response)], used_model, attachments)
+        st.rerun()
+    else:
+        queue_messages(st.session_state.current_conversation_id, [("user", prompt)], attachments=attachments)
 
 if not messages:
     st.info("""
@@ -0,0 +1,141 @@
+"""Serveur local compatible OpenAI/Groq pour les benchmarks.
+
+Répond sur /openai/v1/chat/completions, en SSE (stream: true) ou en JSON,
+avec un temps jusqu'au premier token et un débit de tokens configurables.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Connexions keep-alive fermées par le client à la fin du benchmark
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeGroqServer:
+    def __init__(self, ttft=0.3, tokens_per_second=250.0, completion_tokens=120, error_rate=0.0,
+                 slow_rate=0.0, slow_ttft=5.0, port=0):
+        self.ttft = ttft
+        # Fraction des requêtes dont le premier token met slow_ttft secondes (latence de queue)
+        self.slow_rate = slow_rate
+        self.slow_ttft = slow_ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.server = QuietHTTPServer(("127.0.0.1", port), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-groq", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/openai/v1/chat/completions"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self):
+        with self.lock:
+            return self.requests, self.bytes_received + self.bytes_sent
+
+    def _record(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with server.lock:
+                    server.requests += 1
+                server._record(received=len(body))
+                request = json.loads(body or b"{}")
+
+                if random.random() < server.error_rate:
+                    self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}}, {"retry-after": "0.2"})
+                    return
+
+                words = self._completion(request)
+                usage = {
+                    "prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in request.get("messages", [])),
+                    "completion_tokens": len(words),
+                }
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                ttft = server.slow_ttft if random.random() < server.slow_rate else server.ttft
+                if request.get("stream"):
+                    self._stream(request, words, usage, ttft)
+                else:
+                    time.sleep(ttft)
+                    time.sleep(len(words) / server.tokens_per_second)
+                    self._send_json(200, {
+                        "id": "chatcmpl-bench",
+                        "model": request.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    })
+
+            def _completion(self, request):
+                limit = min(server.completion_tokens, request.get("max_tokens") or server.completion_tokens)
+                prompt = str(request.get("messages", [{}])[-1].get("content", ""))[:40]
+                return [f"tok{i} " for i in range(limit - 1)] + [f"({prompt})"]
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+                server._record(sent=len(data))
+
+            def _stream(self, request, words, usage, ttft):
+                # Comme une API SSE : en-têtes immédiats, puis attente du premier token
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.wfile.flush()
+                time.sleep(ttft)
+                interval = 1 / server.tokens_per_second
+                for word in words:
+                    chunk = {"choices": [{"index": 0, "delta": {"content": word}}], "model": request.get("model")}
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                    time.sleep(interval)
+                final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": usage}}
+                self._write_chunk(f"data: {json.dumps(final)}\n\n")
+                self._write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, text):
+                data = text.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                server._record(sent=len(data))
+
+        return Handler
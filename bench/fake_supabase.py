@@ -0,0 +1,404 @@
+"""Client Supabase en mémoire pour les benchmarks.
+
+Reproduit le sous-ensemble de l'API postgrest-py utilisé par app.py
+(select/insert/upsert/update/delete, filtres, tri, limit, range, rpc) sur les tables
+users, sessions, conversations et messages, et compte chaque aller-retour
+ainsi que les octets qui auraient transité sur le réseau.
+"""
+import itertools
+import json
+import re
+import threading
+from datetime import datetime, timezone
+
+
+class APIResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeAPIError(Exception):
+    """Équivalent de postgrest.exceptions.APIError"""
+
+    def __init__(self, error):
+        super().__init__(error.get("message"))
+        self.code = error.get("code")
+        self.message = error.get("message")
+        self.details = error.get("details")
+        self.hint = error.get("hint")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _sort_key(value):
+    """Comparer nombres, horodatages ISO et chaînes comme le ferait Postgres"""
+    if value is None:
+        return (3, 0, "")
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    text = str(value)
+    if re.fullmatch(r"-?\d+", text):
+        return (0, int(text), "")
+    if re.match(r"\d{4}-\d\d-\d\d", text):
+        parsed = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return (1, parsed.timestamp(), "")
+    return (2, 0, text)
+
+
+def _split_top_level(expression):
+    parts, depth, current = [], 0, ""
+    for char in expression:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        if char == "," and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    if current:
+        parts.append(current)
+    return parts
+
+
+_OPERATORS = {
+    "eq": lambda a, b: _sort_key(a) == _sort_key(b),
+    "neq": lambda a, b: _sort_key(a) != _sort_key(b),
+    "lt": lambda a, b: _sort_key(a) < _sort_key(b),
+    "lte": lambda a, b: _sort_key(a) <= _sort_key(b),
+    "gt": lambda a, b: _sort_key(a) > _sort_key(b),
+    "gte": lambda a, b: _sort_key(a) >= _sort_key(b),
+}
+
+
+def _parse_condition(condition):
+    """Traduire un filtre PostgREST or=(...) / and(...) en prédicat Python"""
+    if condition.startswith("and("):
+        predicates = [_parse_condition(part) for part in _split_top_level(condition[4:-1])]
+        return lambda row: all(predicate(row) for predicate in predicates)
+    if condition.startswith("or("):
+        predicates = [_parse_condition(part) for part in _split_top_level(condition[3:-1])]
+        return lambda row: any(predicate(row) for predicate in predicates)
+    column, operator, value = condition.split(".", 2)
+    value = value.strip('"')
+    compare = _OPERATORS[operator]
+    return lambda row: row.get(column) is not None and compare(row.get(column), value)
+
+
+class Query:
+    """Constructeur de requête chaînable (table().select().eq()...execute())"""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.operation = "select"
+        self.filters = []
+        self.orders = []
+        self.row_limit = None
+        self.row_offset = 0
+        self.payload = None
+        self.columns = "*"
+        self.count = None
+        self.head = False
+        self.on_conflict = None
+        self.ignore_duplicates = False
+
+    def select(self, *columns, count=None, head=None):
+        self.columns = ",".join(columns) or "*"
+        self.count = count
+        self.head = bool(head)
+        return self
+
+    def insert(self, payload, **kwargs):
+        self.operation = "insert"
+        self.payload = payload
+        return self
+
+    def upsert(self, payload, on_conflict="", ignore_duplicates=False, **kwargs):
+        self.operation = "upsert"
+        self.payload = payload
+        self.on_conflict = on_conflict or "id"
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, payload):
+        self.operation = "update"
+        self.payload = payload
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def _filter(self, column, operator, value):
+        compare = _OPERATORS[operator]
+        self.filters.append(lambda row: row.get(column) is not None and compare(row.get(column), value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "eq", value)
+
+    def neq(self, column, value):
+        return self._filter(column, "neq", value)
+
+    def gt(self, column, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column, value):
+        return self._filter(column, "gte", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "lt", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "lte", value)
+
+    def in_(self, column, values):
+        accepted = {str(value) for value in values}
+        self.filters.append(lambda row: str(row.get(column)) in accepted)
+        return self
+
+    def or_(self, expression):
+        predicates = [_parse_condition(part) for part in _split_top_level(expression)]
+        self.filters.append(lambda row: any(predicate(row) for predicate in predicates))
+        return self
+
+    def order(self, column, desc=False, **kwargs):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, size):
+        self.row_limit = size
+        return self
+
+    def range(self, start, end):
+        self.row_offset = start
+        self.row_limit = end - start + 1
+        return self
+
+    def execute(self):
+        return self.db.execute(self)
+
+
+class RPCQuery:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params or {}
+
+    def execute(self):
+        return self.db.execute_rpc(self.name, self.params)
+
+
+def login_with_session(db, params):
+    """Équivalent de la fonction login_with_session (migration 20261017001700)"""
+    user = next((row for row in db.tables["users"] if row["username"] == params["p_username"]), None)
+    if user is None:
+        return [{"status": "unknown_user", "user_id": None, "username": None, "email": None}]
+    if user["password_hash"] != params["p_password_hash"]:
+        return [{"status": "bad_password", "user_id": None, "username": None, "email": None}]
+    db.tables["sessions"][:] = [row for row in db.tables["sessions"] if row["user_id"] != user["id"]]
+    db._insert_rows("sessions", [{
+        "user_id": user["id"],
+        "token": params["p_token"],
+        "expires_at": params["p_expires_at"],
+    }])
+    return [{"status": "ok", "user_id": user["id"], "username": user["username"], "email": user.get("email")}]
+
+
+def register_user_with_conversation(db, params):
+    """Équivalent de la fonction register_user_with_conversation (migration 20261017001700)"""
+    if any(row["username"] == params["p_username"] for row in db.tables["users"]):
+        return [{"status": "username_taken", "user_id": None}]
+    user = db._insert_rows("users", [{
+        "username": params["p_username"],
+        "password_hash": params["p_password_hash"],
+        "email": params.get("p_email"),
+    }])[0]
+    db._insert_rows("conversations", [{"user_id": user["id"], "name": params.get("p_conversation_name", "Conversation 1")}])
+    return [{"status": "ok", "user_id": user["id"]}]
+
+
+def compact_messages(db, params):
+    """Équivalent de la fonction compact_messages (migration 20261017002000)"""
+    first = (_sort_key(params["p_first_created_at"]), _sort_key(params["p_first_message_id"]))
+    last = (_sort_key(params["p_last_created_at"]), _sort_key(params["p_last_message_id"]))
+    compacted = [
+        row for row in db.tables["messages"]
+        if str(row["conversation_id"]) == str(params["p_conversation_id"])
+        and first <= (_sort_key(row["created_at"]), _sort_key(row["id"])) <= last
+    ]
+    if len(compacted) != params["p_message_count"]:
+        raise FakeAPIError({"code": "P0001", "message": "compact_messages: intervalle modifié"})
+    # Suppression sans passer par _on_delete : les compteurs de la conversation sont conservés
+    compacted_ids = {row["id"] for row in compacted}
+    db.tables["messages"][:] = [row for row in db.tables["messages"] if row["id"] not in compacted_ids]
+    segment = db._insert_rows("message_segments", [{
+        "conversation_id": params["p_conversation_id"],
+        "first_created_at": params["p_first_created_at"],
+        "first_message_id": params["p_first_message_id"],
+        "last_created_at": params["p_last_created_at"],
+        "last_message_id": params["p_last_message_id"],
+        "message_count": params["p_message_count"],
+        "codec": params["p_codec"],
+        "payload": params["p_payload"],
+        "raw_bytes": params["p_raw_bytes"],
+    }])[0]
+    return segment["id"]
+
+
+class FakeSupabase:
+    """Base en mémoire partagée par tous les utilisateurs simulés"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {"users": [], "sessions": [], "conversations": [], "messages": [], "message_segments": []}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_transferred = 0
+        # Fonctions Postgres (RPC) émulées : nom -> callable(db, params)
+        self.functions = {
+            "login_with_session": login_with_session,
+            "register_user_with_conversation": register_user_with_conversation,
+            "compact_messages": compact_messages,
+        }
+
+    def table(self, name):
+        with self.lock:
+            self.tables.setdefault(name, [])
+        return Query(self, name)
+
+    def rpc(self, name, params=None):
+        return RPCQuery(self, name, params)
+
+    def snapshot(self):
+        with self.lock:
+            return self.round_trips, self.bytes_transferred
+
+    def _account(self, request, response):
+        self.round_trips += 1
+        self.bytes_transferred += len(json.dumps(request, default=str)) + len(json.dumps(response, default=str))
+
+    def _simulate_network(self):
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def execute_rpc(self, name, params):
+        self._simulate_network()
+        with self.lock:
+            if name not in self.functions:
+                self._account(params, {})
+                raise FakeAPIError({"code": "PGRST202", "message": f"Could not find the function public.{name}"})
+            data = self.functions[name](self, params)
+            self._account(params, data)
+            return APIResponse(data)
+
+    def execute(self, query):
+        self._simulate_network()
+        with self.lock:
+            response = self._execute(query)
+            self._account(query.payload, response.data)
+            return response
+
+    def _execute(self, query):
+        rows = self.tables[query.table]
+        if query.operation in ("insert", "upsert"):
+            return APIResponse(self._insert(query, rows))
+
+        matched = [row for row in rows if all(predicate(row) for predicate in query.filters)]
+        if query.operation == "update":
+            for row in matched:
+                row.update(query.payload)
+            return APIResponse([dict(row) for row in matched])
+        if query.operation == "delete":
+            for row in matched:
+                rows.remove(row)
+                self._on_delete(query.table, row)
+            return APIResponse([dict(row) for row in matched])
+
+        for column, desc in reversed(query.orders):
+            matched.sort(key=lambda row: _sort_key(row.get(column)), reverse=desc)
+        count = len(matched) if query.count else None
+        if query.row_limit is not None:
+            matched = matched[query.row_offset:query.row_offset + query.row_limit]
+        if query.head:
+            return APIResponse([], count)
+        return APIResponse([self._project(row, query.columns) for row in matched], count)
+
+    def _insert_rows(self, table, payload):
+        """Insertion directe, pour les fonctions émulées (verrou déjà pris)"""
+        query = Query(self, table)
+        query.insert(payload)
+        return self._insert(query, self.tables[table])
+
+    def _insert(self, query, rows):
+        payload = query.payload if isinstance(query.payload, list) else [query.payload]
+        inserted = []
+        for values in payload:
+            if query.table == "users" and any(row["username"] == values.get("username") for row in rows):
+                raise FakeAPIError({"code": "23505", "message": "duplicate key value violates unique constraint"})
+            if query.operation == "upsert":
+                keys = query.on_conflict.split(",")
+                existing = [row for row in rows if all(str(row.get(key)) == str(values.get(key)) for key in keys)]
+                if existing:
+                    if not query.ignore_duplicates:
+                        existing[0].update(values)
+                        inserted.append(dict(existing[0]))
+                    continue
+            row = dict(values)
+            row.setdefault("id", next(self.ids))
+            row.setdefault("created_at", _now())
+            if query.table == "conversations":
+                row.setdefault("message_count", 0)
+                row.setdefault("total_chars", 0)
+                row.setdefault("last_message_at", None)
+            rows.append(row)
+            self._on_insert(query.table, row)
+            inserted.append(dict(row))
+        return inserted
+
+    # Équivalents des triggers et clés étrangères du schéma
+    def _on_insert(self, table, row):
+        if table == "messages":
+            self._update_conversation_stats(row, 1)
+
+    def _on_delete(self, table, row):
+        if table == "messages":
+            self._update_conversation_stats(row, -1)
+        elif table == "conversations":
+            for child in ("messages", "message_segments", "conversation_summaries"):
+                if child in self.tables:
+                    self.tables[child][:] = [r for r in self.tables[child] if str(r.get("conversation_id")) != str(row["id"])]
+
+    def _update_conversation_stats(self, message, sign):
+        for conversation in self.tables["conversations"]:
+            if str(conversation["id"]) == str(message["conversation_id"]):
+                conversation["message_count"] += sign
+                conversation["total_chars"] += sign * len(message.get("content") or "")
+                if sign > 0 and _sort_key(message["created_at"]) > _sort_key(conversation["last_message_at"] or "0"):
+                    conversation["last_message_at"] = message["created_at"]
+
+    def _project(self, row, columns):
+        if columns.strip() == "*":
+            return dict(row)
+        projected = {}
+        for part in _split_top_level(columns.replace(" ", "")):
+            embedded = re.match(r"(\w+)\((.*)\)", part)
+            if embedded:
+                # Jointure PostgREST : users(id, username) via la colonne user_id
+                table, sub_columns = embedded.groups()
+                foreign_key = row.get(table[:-1] + "_id")
+                target = next((r for r in self.tables[table] if r["id"] == foreign_key), None)
+                projected[table] = self._project(target, sub_columns) if target else None
+            elif part == "*":
+                projected.update(row)
+            else:
+                projected[part] = row.get(part)
+        return projected
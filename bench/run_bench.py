@@ -0,0 +1,238 @@
+"""Benchmark hors ligne de app.py.
+
+Lance l'application avec streamlit.testing (AppTest) pour plusieurs utilisateurs
+simulés, contre une base Supabase en mémoire et un faux serveur Groq local,
+puis affiche les percentiles de latence par interaction, les allers-retours
+Supabase et les octets transférés.
+
+    python bench/run_bench.py --users 20 --turns 5 --concurrency 4
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(os.path.dirname(BENCH_DIR), "app.py")
+sys.path.insert(0, BENCH_DIR)
+
+from fake_groq import FakeGroqServer  # noqa: E402
+from fake_supabase import FakeSupabase  # noqa: E402
+
+PROMPTS = [
+    "Explique-moi la physique quantique",
+    "Crée une API REST en Python",
+    "Design une carte de profil moderne",
+    "Comment optimiser une requête SQL ?",
+]
+
+
+def install_fake_supabase(db):
+    """Faire renvoyer la base en mémoire par supabase.create_client"""
+    try:
+        import supabase as supabase_module
+    except ImportError:
+        # Paquet absent : module minimal suffisant pour `from supabase import create_client, Client`
+        supabase_module = types.ModuleType("supabase")
+        supabase_module.Client = object
+        sys.modules["supabase"] = supabase_module
+    supabase_module.create_client = lambda url, key: db
+
+
+def share_streamlit_runtime():
+    """Permettre plusieurs AppTest en parallèle.
+
+    Chaque AppTest.run() installe puis efface un Runtime factice global ; avec
+    plusieurs utilisateurs simultanés, un run efface celui d'un autre. On fixe
+    un Runtime factice unique pour tout le benchmark, et le script n'est compilé
+    qu'une fois (compile() n'est pas sûr entre threads en CPython 3.11), comme
+    avec le ScriptCache partagé d'un vrai serveur Streamlit.
+    """
+    from unittest.mock import MagicMock
+
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner import script_cache
+
+    get_bytecode = script_cache.ScriptCache.get_bytecode
+    shared_script_cache = script_cache.ScriptCache()
+    script_cache.ScriptCache.get_bytecode = lambda self, path: get_bytecode(shared_script_cache, path)
+
+    shared_runtime = MagicMock(spec=Runtime)
+    shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: shared_runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+
+def seed(db, users, history):
+    """Créer les comptes (et éventuellement un historique) des utilisateurs simulés"""
+    password_hash = hashlib.sha256(b"benchmark").hexdigest()
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    for index in range(users):
+        user = db.table("users").insert({
+            "username": f"bench{index}",
+            "password_hash": password_hash,
+            "email": f"bench{index}@example.com",
+        }).execute().data[0]
+        conversation = db.table("conversations").insert({"user_id": user["id"], "name": "Conversation 1"}).execute().data[0]
+        rows = [
+            {
+                "conversation_id": conversation["id"],
+                "role": "user" if position % 2 == 0 else "assistant",
+                "content": f"Message d'historique {position} " * 20,
+                "created_at": (start + timedelta(seconds=position)).isoformat(),
+            }
+            for position in range(history)
+        ]
+        if rows:
+            db.table("messages").insert(rows).execute()
+    db.round_trips = 0
+    db.bytes_transferred = 0
+
+
+class Recorder:
+    """Latences et coûts Supabase par type d'interaction"""
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def measure(self, name, action):
+        round_trips, transferred = self.db.snapshot()
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        after_round_trips, after_transferred = self.db.snapshot()
+        with self.lock:
+            self.samples.setdefault(name, []).append(
+                (elapsed, after_round_trips - round_trips, after_transferred - transferred)
+            )
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def simulate_user(index, args, recorder, errors):
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    try:
+        recorder.measure("chargement", app.run)
+        app.text_input(key="login_user").set_value(f"bench{index}")
+        app.text_input(key="login_pass").set_value("benchmark")
+        login_button = next(button for button in app.button if button.label == "Se connecter")
+        recorder.measure("connexion", login_button.click().run)
+        if args.hedging:
+            app.toggle(key="hedging").set_value(True).run()
+        for turn in range(args.turns):
+            prompt = PROMPTS[(index + turn) % len(PROMPTS)]
+            recorder.measure("message", app.chat_input[0].set_value(prompt).run)
+            recorder.measure("rerun", app.run)
+        if app.exception:
+            errors.append(f"bench{index}: {app.exception[0].message}")
+    except Exception as exc:  # noqa: BLE001 - on veut le rapport même si un utilisateur échoue
+        errors.append(f"bench{index}: {exc!r}")
+
+
+def format_report(args, recorder, groq, db, wall_time, errors):
+    lines = [
+        f"Utilisateurs: {args.users}  tours: {args.turns}  concurrence: {args.concurrency}  "
+        f"historique: {args.history} messages  durée totale: {wall_time:.1f} s",
+        "",
+        f"{'interaction':<12}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        f"{'A/R Supabase':>14}{'Ko Supabase':>13}",
+    ]
+    for name, samples in recorder.samples.items():
+        latencies = [sample[0] * 1000 for sample in samples]
+        lines.append(
+            f"{name:<12}{len(samples):>6}"
+            f"{percentile(latencies, 0.5):>10.0f}{percentile(latencies, 0.9):>10.0f}"
+            f"{percentile(latencies, 0.99):>10.0f}{max(latencies):>10.0f}"
+            f"{statistics.mean(s[1] for s in samples):>14.1f}"
+            f"{statistics.mean(s[2] for s in samples) / 1024:>13.1f}"
+        )
+    groq_requests, groq_bytes = groq.snapshot()
+    supabase_round_trips, supabase_bytes = db.snapshot()
+    lines += [
+        "",
+        f"Supabase : {supabase_round_trips} allers-retours, {supabase_bytes / 1024:.0f} Ko",
+        f"Groq     : {groq_requests} requêtes, {groq_bytes / 1024:.0f} Ko",
+    ]
+    if args.concurrency > 1:
+        lines.append("(allers-retours par interaction approximatifs : les utilisateurs s'exécutent en parallèle)")
+    if errors:
+        lines += ["", f"{len(errors)} erreur(s) :"] + [f"  {error}" for error in errors[:20]]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--history", type=int, default=0, help="messages existants par utilisateur")
+    parser.add_argument("--groq-ttft", type=float, default=0.3, help="secondes avant le premier token")
+    parser.add_argument("--groq-tps", type=float, default=250.0, help="tokens par seconde")
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--groq-error-rate", type=float, default=0.0)
+    parser.add_argument("--groq-slow-rate", type=float, default=0.0, help="fraction de requêtes à premier token lent")
+    parser.add_argument("--groq-slow-ttft", type=float, default=5.0, help="secondes avant le premier token d'une requête lente")
+    parser.add_argument("--hedging", action="store_true", help="activer les requêtes de secours")
+    parser.add_argument("--supabase-latency", type=float, default=0.02, help="secondes par aller-retour")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="fichier où écrire le rapport (ex. bench_output.txt)")
+    args = parser.parse_args(argv)
+
+    db = FakeSupabase(latency=args.supabase_latency)
+    groq = FakeGroqServer(
+        ttft=args.groq_ttft,
+        tokens_per_second=args.groq_tps,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.groq_error_rate,
+        slow_rate=args.groq_slow_rate,
+        slow_ttft=args.groq_slow_ttft,
+    ).start()
+    install_fake_supabase(db)
+    if args.concurrency > 1:
+        share_streamlit_runtime()
+    os.environ.update({
+        "SUPABASE_URL": "http://supabase.bench",
+        "SUPABASE_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "GROQ_API_URL": groq.url,
+        "RESPONSE_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="frejus-bench-"), "responses.sqlite3"),
+    })
+    seed(db, args.users, args.history)
+
+    recorder = Recorder(db)
+    errors = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for index in range(args.users):
+            pool.submit(simulate_user, index, args, recorder, errors)
+    wall_time = time.perf_counter() - started
+    groq.stop()
+
+    report = format_report(args, recorder, groq, db, wall_time, errors)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(report + "\n")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""Compaction de l'historique ancien des conversations.
+
+Les messages plus anciens qu'un seuil sont regroupés en segments : un tableau
+JSON compressé (zstd si le paquet zstandard est installé, sinon zlib) par
+tranche de messages consécutifs, bornée par (created_at, id) du premier et du
+dernier message. La fonction Postgres compact_messages insère le segment et
+supprime les lignes correspondantes dans une même transaction, sans modifier
+les compteurs de la conversation (les messages compactés restent comptés).
+
+L'application ne décompresse un segment que lorsque l'utilisateur remonte
+jusqu'à lui dans l'historique.
+
+    python compaction.py --min-age-days 30 --keep-recent 200
+    python compaction.py --dry-run
+"""
+import argparse
+import base64
+import json
+import sys
+import zlib
+from datetime import datetime, timedelta, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPACTION_MIN_AGE_DAYS = 30
+# Derniers messages de chaque conversation jamais compactés, quel que soit leur âge
+COMPACTION_KEEP_RECENT = 200
+SEGMENT_SIZE = 500
+# En dessous, les messages restent en lignes (segment trop petit pour valoir la peine)
+SEGMENT_MIN_SIZE = 50
+SEGMENT_FIELDS = ("id", "role", "content", "created_at", "model", "attachments")
+
+
+def compress(data):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("segment zstd : installer le paquet zstandard pour le lire")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"codec de segment inconnu : {codec}")
+
+
+def encode_segment(messages):
+    """Messages (ordre chronologique) -> colonnes codec, payload (base64) et raw_bytes"""
+    raw = json.dumps(
+        [{field: message.get(field) for field in SEGMENT_FIELDS if message.get(field) is not None} for message in messages],
+        ensure_ascii=False,
+        separators=(",", ":")
+    ).encode("utf-8")
+    codec, compressed = compress(raw)
+    return {
+        'codec': codec,
+        'payload': base64.b64encode(compressed).decode("ascii"),
+        'raw_bytes': len(raw)
+    }
+
+
+def decode_segment(segment):
+    """Ligne de message_segments -> messages au format de la table messages"""
+    messages = json.loads(decompress(segment['codec'], base64.b64decode(segment['payload'])))
+    for message in messages:
+        message['conversation_id'] = segment['conversation_id']
+    return messages
+
+
+def iter_segments(client, conversation_id):
+    """Segments d'une conversation, du plus ancien au plus récent, un à la fois (table absente : aucun)"""
+    try:
+        result = client.table('message_segments').select('id').eq('conversation_id', conversation_id).order('first_created_at').execute()
+    except Exception:
+        return
+    for row in result.data:
+        yield client.table('message_segments').select('*').eq('id', row['id']).execute().data[0]
+
+
+def compaction_boundary(client, conversation_id, cutoff, keep_recent):
+    """created_at en deçà duquel les messages peuvent être compactés (None : rien à faire)"""
+    result = client.table('messages').select('created_at').eq('conversation_id', conversation_id).order(
+        'created_at', desc=True
+    ).order('id', desc=True).range(keep_recent, keep_recent).execute()
+    if not result.data:
+        return None
+    # Le (keep_recent + 1)-ième message le plus récent est compactable, les suivants aussi
+    newest_compactable = datetime.fromisoformat(result.data[0]['created_at'].replace('Z', '+00:00'))
+    if newest_compactable.tzinfo is None:
+        newest_compactable = newest_compactable.replace(tzinfo=timezone.utc)
+    return min(cutoff, newest_compactable + timedelta(microseconds=1))
+
+
+def compact_conversation(client, conversation_id, cutoff, keep_recent=COMPACTION_KEEP_RECENT,
+                         segment_size=SEGMENT_SIZE, dry_run=False):
+    """Compacter les anciens messages d'une conversation ; renvoie (messages, octets bruts, octets compressés)"""
+    totals = [0, 0, 0]
+    boundary = compaction_boundary(client, conversation_id, cutoff, keep_recent)
+    if boundary is None:
+        return tuple(totals)
+
+    last = None
+    while True:
+        query = client.table('messages').select('*').eq('conversation_id', conversation_id).lt('created_at', boundary.isoformat())
+        if dry_run and last:
+            # Sans suppression, avancer par keyset
+            query = query.or_(f'created_at.gt."{last["created_at"]}",and(created_at.eq."{last["created_at"]}",id.gt."{last["id"]}")')
+        page = query.order('created_at').order('id').limit(segment_size).execute().data
+        if len(page) < SEGMENT_MIN_SIZE:
+            break
+
+        encoded = encode_segment(page)
+        if not dry_run:
+            client.rpc('compact_messages', {
+                'p_conversation_id': conversation_id,
+                'p_first_created_at': page[0]['created_at'],
+                'p_first_message_id': page[0]['id'],
+                'p_last_created_at': page[-1]['created_at'],
+                'p_last_message_id': page[-1]['id'],
+                'p_message_count': len(page),
+                'p_codec': encoded['codec'],
+                'p_payload': encoded['payload'],
+                'p_raw_bytes': encoded['raw_bytes']
+            }).execute()
+        totals[0] += len(page)
+        totals[1] += encoded['raw_bytes']
+        totals[2] += len(encoded['payload'])
+        last = page[-1]
+        if len(page) < segment_size:
+            break
+    return tuple(totals)
+
+
+def compact_all(client, min_age_days=COMPACTION_MIN_AGE_DAYS, keep_recent=COMPACTION_KEEP_RECENT,
+                segment_size=SEGMENT_SIZE, dry_run=False, conversation_ids=None, progress=None):
+    """Compacter toutes les conversations assez longues (ou seulement conversation_ids)"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=min_age_days)
+    if conversation_ids is None:
+        result = client.table('conversations').select('id').gt('message_count', keep_recent + SEGMENT_MIN_SIZE - 1).execute()
+        conversation_ids = [row['id'] for row in result.data]
+
+    totals = [0, 0, 0]
+    for conversation_id in conversation_ids:
+        counts = compact_conversation(client, conversation_id, cutoff, keep_recent, segment_size, dry_run)
+        totals = [total + count for total, count in zip(totals, counts)]
+        if progress and counts[0]:
+            progress(conversation_id, counts)
+    return tuple(totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-age-days", type=int, default=COMPACTION_MIN_AGE_DAYS)
+    parser.add_argument("--keep-recent", type=int, default=COMPACTION_KEEP_RECENT)
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE)
+    parser.add_argument("--conversation", action="append", help="id de conversation (répétable)")
+    parser.add_argument("--dry-run", action="store_true", help="mesurer sans rien modifier")
+    args = parser.parse_args(argv)
+
+    from conversation_io import create_client_from_env
+    client = create_client_from_env()
+    messages, raw_bytes, stored_bytes = compact_all(
+        client, args.min_age_days, args.keep_recent, args.segment_size, args.dry_run, args.conversation,
+        progress=lambda conversation_id, counts: print(f"{conversation_id} : {counts[0]} messages compactés", file=sys.stderr)
+    )
+    ratio = f" ({100 * stored_bytes // raw_bytes} % de la taille JSON)" if raw_bytes else ""
+    prefix = "[simulation] " if args.dry_run else ""
+    print(f"{prefix}{messages} messages en segments : {raw_bytes // 1024} Ko -> {stored_bytes // 1024} Ko{ratio}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""Export et import des conversations d'un utilisateur au format JSONL.
+
+Une ligne par enregistrement, dans l'ordre : chaque conversation puis ses
+messages par ordre chronologique.
+
+    {"type": "conversation", "id": "...", "name": "...", "created_at": "..."}
+    {"type": "message", "conversation_id": "...", "role": "user", "content": "...", "created_at": "..."}
+
+L'export lit les messages par pages (pagination keyset sur created_at, id) et
+écrit au fil de l'eau : la mémoire utilisée ne dépend pas du nombre de messages.
+Les messages compactés (voir compaction.py) sont exportés segment par segment.
+L'import insère les messages par lots et enregistre un point de reprise après
+chaque lot ; relancé avec le même point de reprise, il repart de la dernière
+ligne validée. Les ids sont calculés à partir de l'id de l'import (gardé dans
+le point de reprise) et de la ligne source : une écriture rejouée, après un
+timeout ou une reprise, ne crée pas de doublon. Les fichiers .gz sont
+(dé)compressés à la volée.
+
+    python conversation_io.py export --user alice --output alice.jsonl.gz
+    python conversation_io.py import --user bob --input alice.jsonl.gz --checkpoint alice.ckpt
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import compaction
+
+EXPORT_PAGE_SIZE = 1000
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_ATTEMPTS = 5
+IMPORT_BACKOFF_BASE = 0.5
+IMPORT_BACKOFF_MAX = 10
+# Colonnes facultatives des messages (absentes si la migration n'est pas appliquée)
+OPTIONAL_MESSAGE_FIELDS = ("model", "attachments")
+
+
+def open_jsonl(path, mode="r"):
+    """Ouvrir un fichier JSONL en texte, compressé si son nom finit par .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8", newline="\n")
+
+
+def get_user_id(client, username):
+    result = client.table('users').select('id').eq('username', username).execute()
+    if not result.data:
+        raise ValueError(f"Utilisateur introuvable : {username}")
+    return result.data[0]['id']
+
+
+def iter_conversation_messages(client, conversation_id, page_size=EXPORT_PAGE_SIZE):
+    """Messages d'une conversation par ordre chronologique : segments compactés, puis lignes page par page (keyset)"""
+    for segment in compaction.iter_segments(client, conversation_id):
+        yield from compaction.decode_segment(segment)
+    last = None
+    while True:
+        query = client.table('messages').select('*').eq('conversation_id', conversation_id)
+        if last:
+            query = query.or_(
+                f'created_at.gt."{last["created_at"]}",and(created_at.eq."{last["created_at"]}",id.gt."{last["id"]}")'
+            )
+        page = query.order('created_at').order('id').limit(page_size).execute().data
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def iter_export_records(client, user_id, page_size=EXPORT_PAGE_SIZE):
+    """Enregistrements à exporter (conversations puis leurs messages), sans tout charger"""
+    conversations = client.table('conversations').select('id, name, created_at').eq('user_id', user_id).order('created_at').execute().data
+    for conversation in conversations:
+        yield {
+            'type': 'conversation',
+            'id': conversation['id'],
+            'name': conversation['name'],
+            'created_at': conversation['created_at']
+        }
+        for message in iter_conversation_messages(client, conversation['id'], page_size):
+            record = {
+                'type': 'message',
+                'conversation_id': message['conversation_id'],
+                'role': message['role'],
+                'content': message['content'],
+                'created_at': message['created_at']
+            }
+            for field in OPTIONAL_MESSAGE_FIELDS:
+                if message.get(field) is not None:
+                    record[field] = message[field]
+            yield record
+
+
+def export_conversations(client, user_id, output, page_size=EXPORT_PAGE_SIZE, progress=None):
+    """Écrire les conversations de user_id dans output (fichier texte) ; renvoie le nombre de messages"""
+    counts = {'conversations': 0, 'messages': 0}
+    for record in iter_export_records(client, user_id, page_size):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        counts[record['type'] + 's'] += 1
+        if progress and record['type'] == 'message' and counts['messages'] % page_size == 0:
+            progress(counts)
+    if progress:
+        progress(counts)
+    return counts['messages']
+
+
+def _with_retries(operation):
+    """Réessayer une écriture (timeouts, limites de débit) avec backoff exponentiel"""
+    for attempt in range(IMPORT_MAX_ATTEMPTS):
+        try:
+            return operation()
+        except Exception as e:
+            # Erreurs de données (contraintes, colonnes) : inutile de réessayer
+            code = str(getattr(e, 'code', '') or '')
+            if attempt == IMPORT_MAX_ATTEMPTS - 1 or code.startswith(('22', '23', 'PGRST2')):
+                raise
+            time.sleep(min(IMPORT_BACKOFF_MAX, IMPORT_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1))
+
+
+def _upsert(client, table, rows):
+    """Insérer des lignes à id fixé ; celles déjà présentes (écriture rejouée) sont ignorées"""
+    return _with_retries(lambda: client.table(table).upsert(rows, on_conflict='id', ignore_duplicates=True).execute())
+
+
+def _insert_messages(client, rows):
+    try:
+        _upsert(client, 'messages', rows)
+    except Exception as e:
+        if getattr(e, 'code', None) != 'PGRST204':
+            raise
+        # Colonne facultative absente dans la base cible : importer sans elle
+        rows = [{key: value for key, value in row.items() if key not in OPTIONAL_MESSAGE_FIELDS} for row in rows]
+        _upsert(client, 'messages', rows)
+
+
+def import_conversations(client, user_id, source, state=None, save_state=None, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """Importer un export JSONL (itérable de lignes) dans les conversations de user_id.
+
+    state est le point de reprise, modifié sur place : dernière ligne validée et
+    correspondance des ids de conversation. save_state(state) est appelé après
+    chaque conversation créée et chaque lot inséré. Renvoie state.
+    """
+    if state is None:
+        state = {}
+    if 'import_id' not in state:
+        # Espace de noms des ids de cet import, enregistré avant toute écriture
+        state['import_id'] = str(uuid.uuid4())
+        if save_state:
+            save_state(state)
+    namespace = uuid.UUID(state['import_id'])
+    state.setdefault('line', 0)
+    state.setdefault('conversations', {})
+    state.setdefault('messages', 0)
+    batch = []
+    batch_end = state['line']
+
+    def flush():
+        nonlocal batch
+        if batch:
+            _insert_messages(client, batch)
+            state['messages'] += len(batch)
+            batch = []
+        state['line'] = batch_end
+        if save_state:
+            save_state(state)
+        if progress:
+            progress(state)
+
+    for line_number, line in enumerate(source, start=1):
+        if line_number <= state['line'] or not line.strip():
+            continue
+        record = json.loads(line)
+
+        if record['type'] == 'conversation':
+            # Les messages de la conversation précédente sont validés avant d'en créer une autre
+            flush()
+            conversation_id = str(uuid.uuid5(namespace, f"conversation:{record['id']}"))
+            _upsert(client, 'conversations', {
+                'id': conversation_id,
+                'user_id': user_id,
+                'name': record['name']
+            })
+            state['conversations'][str(record['id'])] = conversation_id
+            batch_end = line_number
+            flush()
+        elif record['type'] == 'message':
+            conversation_id = state['conversations'].get(str(record['conversation_id']))
+            if conversation_id is None:
+                raise ValueError(f"Ligne {line_number} : message sans conversation {record['conversation_id']}")
+            row = {
+                'id': str(uuid.uuid5(namespace, f"message:{line_number}")),
+                'conversation_id': conversation_id,
+                'role': record['role'],
+                'content': record['content'],
+                'created_at': record['created_at']
+            }
+            for field in OPTIONAL_MESSAGE_FIELDS:
+                if record.get(field) is not None:
+                    row[field] = record[field]
+            batch.append(row)
+            batch_end = line_number
+            if len(batch) >= chunk_size:
+                flush()
+
+    flush()
+    state['done'] = True
+    if save_state:
+        save_state(state)
+    return state
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as handle:
+            return json.load(handle)
+    return {}
+
+
+def write_checkpoint(path, state):
+    """Écriture atomique : un arrêt brutal ne laisse jamais de point de reprise tronqué"""
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as handle:
+        json.dump(state, handle)
+    os.replace(temporary, path)
+
+
+def create_client_from_env():
+    from supabase import create_client
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_KEY")
+    if not url or not key:
+        raise SystemExit("SUPABASE_URL et SUPABASE_KEY doivent être définis")
+    return create_client(url, key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="exporter les conversations d'un utilisateur")
+    export_parser.add_argument("--user", required=True, help="nom d'utilisateur")
+    export_parser.add_argument("--output", required=True, help="fichier .jsonl ou .jsonl.gz")
+    export_parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    import_parser = subparsers.add_parser("import", help="importer un export dans le compte d'un utilisateur")
+    import_parser.add_argument("--user", required=True, help="nom d'utilisateur")
+    import_parser.add_argument("--input", required=True, help="fichier .jsonl ou .jsonl.gz")
+    import_parser.add_argument("--checkpoint", help="point de reprise (défaut : <input>.checkpoint)")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    client = create_client_from_env()
+    user_id = get_user_id(client, args.user)
+
+    if args.command == "export":
+        with open_jsonl(args.output, "w") as output:
+            count = export_conversations(
+                client, user_id, output, args.page_size,
+                progress=lambda counts: print(f"{counts['conversations']} conversations, {counts['messages']} messages", file=sys.stderr)
+            )
+        print(f"Export terminé : {count} messages -> {args.output}", file=sys.stderr)
+        return 0
+
+    checkpoint = args.checkpoint or args.input + ".checkpoint"
+    state = load_checkpoint(checkpoint)
+    if state.get('done'):
+        print(f"Import déjà terminé selon {checkpoint}", file=sys.stderr)
+        return 0
+    if state:
+        print(f"Reprise à la ligne {state['line'] + 1}", file=sys.stderr)
+    with open_jsonl(args.input) as source:
+        state = import_conversations(
+            client, user_id, source, state,
+            save_state=lambda current: write_checkpoint(checkpoint, current),
+            chunk_size=args.chunk_size,
+            progress=lambda current: print(f"ligne {current['line']}, {current['messages']} messages importés", file=sys.stderr)
+        )
+    print(f"Import terminé : {state['messages']} messages, {len(state['conversations'])} conversations", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
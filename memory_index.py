@@ -0,0 +1,157 @@
+"""Index local d'embeddings pour la mémoire entre conversations.
+
+Les vecteurs sont calculés sur CPU, sans modèle : hachage signé des mots et de
+leurs n-grammes de caractères (3 à 5) dans EMBEDDING_DIM dimensions, puis
+normalisation (la similarité cosinus devient un produit scalaire). Chaque
+utilisateur a son index : une matrice NumPy agrandie par doublement, à laquelle
+les nouveaux messages sont ajoutés un par un ; une recherche est un produit
+matrice-vecteur suivi d'une sélection des k meilleurs scores. La taille d'un
+index est bornée : au-delà de max_entries, les entrées les plus anciennes sont
+évincées par blocs (EVICTION_FRACTION) pour ne pas recopier la matrice à chaque ajout.
+"""
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+CHAR_NGRAM_SIZES = (3, 4, 5)
+# Au-delà, le début du message suffit à le caractériser (coût d'indexation borné)
+EMBED_MAX_CHARS = 8000
+INITIAL_CAPACITY = 256
+EVICTION_FRACTION = 0.1
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize_text(text):
+    """Minuscules sans accents : « café » et « cafe » partagent leurs n-grammes"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def iter_features(text):
+    for word in WORD_PATTERN.findall(normalize_text(text[:EMBED_MAX_CHARS])):
+        yield "w:" + word
+        padded = f" {word} "
+        for size in CHAR_NGRAM_SIZES:
+            for start in range(len(padded) - size + 1):
+                yield padded[start:start + size]
+
+
+def embed(text):
+    """Vecteur normalisé (float32) d'un texte ; nul si le texte n'a aucun mot"""
+    indices, signs = [], []
+    for feature in iter_features(text):
+        hashed = zlib.crc32(feature.encode("utf-8"))
+        indices.append(hashed % EMBEDDING_DIM)
+        # Bit de poids fort pour le signe : les collisions se compensent en moyenne
+        signs.append(1.0 if hashed & 0x80000000 else -1.0)
+    vector = np.bincount(indices, weights=signs, minlength=EMBEDDING_DIM).astype(np.float32)
+    # Fréquences amorties : un mot répété ne domine pas le vecteur
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class MemoryIndex:
+    """Vecteurs des messages d'un utilisateur et leurs métadonnées (ajouts incrémentaux, thread-safe).
+
+    Chaque entrée est un dict avec au moins 'key' (identifiant stable du message)
+    et 'conversation_id'. Les entrées sont supposées ajoutées de la plus ancienne
+    à la plus récente : ce sont les premières qui sont évincées.
+    """
+
+    def __init__(self, max_entries=None):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.vectors = np.zeros((self._capacity(INITIAL_CAPACITY), EMBEDDING_DIM), dtype=np.float32)
+        self.entries = []
+        self.keys = set()
+
+    def _capacity(self, wanted):
+        return min(wanted, self.max_entries) if self.max_entries else wanted
+
+    def _keep(self, kept):
+        """Ne conserver que les entrées aux positions kept (appelant détenant le verrou)"""
+        vectors = np.zeros((self._capacity(max(INITIAL_CAPACITY, 2 * len(kept))), EMBEDDING_DIM), dtype=np.float32)
+        vectors[:len(kept)] = self.vectors[kept]
+        self.vectors = vectors
+        self.entries = [self.entries[position] for position in kept]
+        self.keys = {entry['key'] for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry, vector):
+        """Ajouter un message ; renvoie False s'il est déjà indexé"""
+        with self.lock:
+            if entry['key'] in self.keys:
+                return False
+            count = len(self.entries)
+            if self.max_entries and count >= self.max_entries:
+                evicted = max(1, int(self.max_entries * EVICTION_FRACTION))
+                self._keep(list(range(count - self.max_entries + evicted, count)))
+                count = len(self.entries)
+            if count == len(self.vectors):
+                grown = np.zeros((self._capacity(2 * count), EMBEDDING_DIM), dtype=np.float32)
+                grown[:count] = self.vectors
+                self.vectors = grown
+            self.vectors[count] = vector
+            self.entries.append(entry)
+            self.keys.add(entry['key'])
+            return True
+
+    def remove_conversation(self, conversation_id):
+        """Oublier les messages d'une conversation supprimée"""
+        with self.lock:
+            kept = [position for position, entry in enumerate(self.entries) if entry['conversation_id'] != conversation_id]
+            if len(kept) == len(self.entries):
+                return
+            self._keep(kept)
+
+    def search(self, vector, k, min_score=0.0, exclude=()):
+        """k entrées les plus proches de vector (score >= min_score), hors clés de exclude, avec leur score"""
+        with self.lock:
+            count = len(self.entries)
+            if not count or k <= 0:
+                return []
+            scores = self.vectors[:count] @ vector
+            entries = self.entries[:count]
+        candidates = min(count, k + len(exclude))
+        best = np.argpartition(-scores, candidates - 1)[:candidates]
+        results = []
+        for position in best[np.argsort(-scores[best])]:
+            if scores[position] < min_score:
+                break
+            if entries[position]['key'] in exclude:
+                continue
+            results.append(dict(entries[position], score=float(scores[position])))
+            if len(results) == k:
+                break
+        return results
+
+
+class MemoryStore:
+    """Index par utilisateur pour tout le processus ; les moins récemment utilisés sont évincés"""
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()
+
+    def get(self, user_id):
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is not None:
+                self.indexes.move_to_end(user_id)
+            return index
+
+    def put(self, user_id, index):
+        with self.lock:
+            self.indexes[user_id] = index
+            self.indexes.move_to_end(user_id)
+            while len(self.indexes) > self.max_users:
+                self.indexes.popitem(last=False)
@@ -0,0 +1,54 @@
+-- Statistiques par conversation tenues à jour côté serveur
+-- (nombre de messages, caractères, dernière activité) pour éviter
+-- de télécharger tous les messages juste pour les compter.
+
+alter table public.conversations
+    add column if not exists message_count bigint not null default 0,
+    add column if not exists total_chars bigint not null default 0,
+    add column if not exists last_message_at timestamptz;
+
+create index if not exists messages_conversation_created_at_idx
+    on public.messages (conversation_id, created_at);
+
+create or replace function public.update_conversation_stats()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' then
+        update public.conversations
+           set message_count = message_count + 1,
+               total_chars = total_chars + coalesce(char_length(new.content), 0),
+               last_message_at = greatest(coalesce(last_message_at, new.created_at), new.created_at)
+         where id = new.conversation_id;
+        return new;
+    elsif tg_op = 'DELETE' then
+        update public.conversations
+           set message_count = greatest(message_count - 1, 0),
+               total_chars = greatest(total_chars - coalesce(char_length(old.content), 0), 0)
+         where id = old.conversation_id;
+        return old;
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists messages_update_conversation_stats on public.messages;
+create trigger messages_update_conversation_stats
+    after insert or delete on public.messages
+    for each row execute function public.update_conversation_stats();
+
+-- Rattrapage des conversations existantes
+update public.conversations c
+   set message_count = s.message_count,
+       total_chars = s.total_chars,
+       last_message_at = s.last_message_at
+  from (
+      select conversation_id,
+             count(*) as message_count,
+             coalesce(sum(char_length(content)), 0) as total_chars,
+             max(created_at) as last_message_at
+        from public.messages
+       group by conversation_id
+  ) s
+ where s.conversation_id = c.id;
@@ -0,0 +1,9 @@
+-- Résumés glissants des conversations longues : les anciens échanges sont
+-- remplacés par un résumé persistant, mis à jour de façon incrémentale.
+
+create table if not exists public.conversation_summaries (
+    conversation_id uuid primary key references public.conversations (id) on delete cascade,
+    summary text not null,
+    summarized_until timestamptz not null,
+    updated_at timestamptz not null default now()
+);
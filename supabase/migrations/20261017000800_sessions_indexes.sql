@@ -0,0 +1,3 @@
+-- Validation des tokens et nettoyage périodique des sessions expirées
+create unique index if not exists sessions_token_idx on public.sessions (token);
+create index if not exists sessions_expires_at_idx on public.sessions (expires_at);
@@ -0,0 +1,2 @@
+-- Modèle Groq ayant produit chaque réponse (routage automatique)
+alter table public.messages add column if not exists model text;
@@ -0,0 +1,46 @@
+-- Recherche plein texte dans les messages d'un utilisateur.
+-- Index GIN sur expression plutôt que colonne tsvector générée : les
+-- select('*') de l'application ne transportent pas le vecteur.
+
+create index if not exists messages_content_fts_idx
+    on public.messages using gin (to_tsvector('french', content));
+
+create index if not exists conversations_user_id_idx
+    on public.conversations (user_id);
+
+-- Résultats classés ; ts_headline n'est calculé que pour les p_limit meilleurs
+create or replace function public.search_messages(p_user_id uuid, p_query text, p_limit integer default 20)
+returns table (
+    message_id uuid,
+    conversation_id uuid,
+    conversation_name text,
+    role text,
+    created_at timestamptz,
+    snippet text,
+    rank real
+)
+language sql
+stable
+as $$
+    with query as (
+        select websearch_to_tsquery('french', p_query) as tsquery
+    ),
+    hits as (
+        select m.id, m.conversation_id, c.name, m.role, m.created_at, m.content,
+               ts_rank_cd(to_tsvector('french', m.content), query.tsquery) as rank
+        from public.messages m
+        join public.conversations c on c.id = m.conversation_id
+        cross join query
+        where c.user_id = p_user_id
+          and to_tsvector('french', m.content) @@ query.tsquery
+        order by rank desc, m.created_at desc
+        limit least(greatest(p_limit, 1), 100)
+    )
+    select hits.id, hits.conversation_id, hits.name, hits.role, hits.created_at,
+           ts_headline('french', hits.content, query.tsquery,
+                       'StartSel=**, StopSel=**, MaxWords=30, MinWords=12, MaxFragments=2, FragmentDelimiter=" … "'),
+           hits.rank
+    from hits
+    cross join query
+    order by hits.rank desc, hits.created_at desc;
+$$;
@@ -0,0 +1,72 @@
+-- Connexion et inscription en un seul aller-retour, de façon atomique.
+-- Le mot de passe arrive déjà haché par l'application ; le token de session
+-- est généré côté application (secrets.token_urlsafe).
+
+-- Unicité garantie par la base même en cas d'inscriptions simultanées
+-- (échoue si des doublons existent déjà : les fusionner avant d'appliquer)
+create unique index if not exists users_username_key on public.users (username);
+
+-- Vérifier les identifiants, remplacer les sessions de l'utilisateur par la
+-- nouvelle et renvoyer uniquement les colonnes utiles (jamais password_hash)
+create or replace function public.login_with_session(
+    p_username text,
+    p_password_hash text,
+    p_token text,
+    p_expires_at timestamptz
+)
+returns table (status text, user_id uuid, username text, email text)
+language plpgsql
+security definer
+set search_path = public
+as $$
+#variable_conflict use_column
+declare
+    v_user public.users%rowtype;
+begin
+    select * into v_user from public.users u where u.username = p_username;
+    if not found then
+        return query select 'unknown_user'::text, null::uuid, null::text, null::text;
+        return;
+    end if;
+    if v_user.password_hash is distinct from p_password_hash then
+        return query select 'bad_password'::text, null::uuid, null::text, null::text;
+        return;
+    end if;
+
+    delete from public.sessions s where s.user_id = v_user.id;
+    insert into public.sessions (user_id, token, expires_at) values (v_user.id, p_token, p_expires_at);
+
+    return query select 'ok'::text, v_user.id, v_user.username, v_user.email;
+end;
+$$;
+
+-- Créer l'utilisateur et sa première conversation ; 'username_taken' si le nom existe
+create or replace function public.register_user_with_conversation(
+    p_username text,
+    p_password_hash text,
+    p_email text,
+    p_conversation_name text default 'Conversation 1'
+)
+returns table (status text, user_id uuid)
+language plpgsql
+security definer
+set search_path = public
+as $$
+#variable_conflict use_column
+declare
+    v_user_id uuid;
+begin
+    insert into public.users (username, password_hash, email)
+    values (p_username, p_password_hash, p_email)
+    on conflict (username) do nothing
+    returning id into v_user_id;
+
+    if v_user_id is null then
+        return query select 'username_taken'::text, null::uuid;
+        return;
+    end if;
+
+    insert into public.conversations (user_id, name) values (v_user_id, p_conversation_name);
+    return query select 'ok'::text, v_user_id;
+end;
+$$;
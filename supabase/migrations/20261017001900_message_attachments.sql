@@ -0,0 +1,16 @@
+-- Images jointes aux messages. Les messages ne portent que les métadonnées
+-- (empreinte, dimensions) : l'historique reste léger. Les images recompressées
+-- sont stockées une seule fois par empreinte SHA-256.
+
+alter table public.messages add column if not exists attachments jsonb;
+
+create table if not exists public.message_attachments (
+    sha256 text primary key,
+    user_id uuid references public.users (id) on delete set null,
+    mime_type text not null,
+    width integer not null,
+    height integer not null,
+    byte_size integer not null,
+    data text not null,
+    created_at timestamptz not null default now()
+);
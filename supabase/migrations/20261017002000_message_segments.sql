@@ -0,0 +1,94 @@
+-- Stockage froid de l'historique : les anciens messages d'une conversation
+-- sont regroupés en segments compressés (voir compaction.py). Chaque segment
+-- couvre l'intervalle [(first_created_at, first_message_id), (last_created_at, last_message_id)].
+
+create table if not exists public.message_segments (
+    id uuid primary key default gen_random_uuid(),
+    conversation_id uuid not null references public.conversations (id) on delete cascade,
+    first_created_at timestamptz not null,
+    first_message_id uuid not null,
+    last_created_at timestamptz not null,
+    last_message_id uuid not null,
+    message_count integer not null,
+    codec text not null,
+    payload text not null,  -- JSON compressé, encodé en base64
+    raw_bytes integer not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists message_segments_conversation_last_idx
+    on public.message_segments (conversation_id, last_created_at desc, last_message_id desc);
+
+-- Les messages compactés restent comptés dans les statistiques de la conversation
+create or replace function public.update_conversation_stats()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' then
+        update public.conversations
+           set message_count = message_count + 1,
+               total_chars = total_chars + coalesce(char_length(new.content), 0),
+               last_message_at = greatest(coalesce(last_message_at, new.created_at), new.created_at)
+         where id = new.conversation_id;
+        return new;
+    elsif tg_op = 'DELETE' then
+        if current_setting('frejus.compacting', true) = 'on' then
+            return old;
+        end if;
+        update public.conversations
+           set message_count = greatest(message_count - 1, 0),
+               total_chars = greatest(total_chars - coalesce(char_length(old.content), 0), 0)
+         where id = old.conversation_id;
+        return old;
+    end if;
+    return null;
+end;
+$$;
+
+-- Créer le segment et supprimer les lignes qu'il remplace, atomiquement.
+-- Échoue (et annule tout) si l'intervalle ne contient plus exactement les
+-- messages encodés, par exemple après une écriture concurrente.
+create or replace function public.compact_messages(
+    p_conversation_id uuid,
+    p_first_created_at timestamptz,
+    p_first_message_id uuid,
+    p_last_created_at timestamptz,
+    p_last_message_id uuid,
+    p_message_count integer,
+    p_codec text,
+    p_payload text,
+    p_raw_bytes integer
+)
+returns uuid
+language plpgsql
+as $$
+declare
+    v_deleted integer;
+    v_segment_id uuid;
+begin
+    perform set_config('frejus.compacting', 'on', true);
+
+    delete from public.messages m
+     where m.conversation_id = p_conversation_id
+       and (m.created_at, m.id) >= (p_first_created_at, p_first_message_id)
+       and (m.created_at, m.id) <= (p_last_created_at, p_last_message_id);
+    get diagnostics v_deleted = row_count;
+
+    if v_deleted <> p_message_count then
+        raise exception 'compact_messages: % messages dans l''intervalle, % attendus', v_deleted, p_message_count;
+    end if;
+
+    insert into public.message_segments (
+        conversation_id, first_created_at, first_message_id, last_created_at, last_message_id,
+        message_count, codec, payload, raw_bytes
+    ) values (
+        p_conversation_id, p_first_created_at, p_first_message_id, p_last_created_at, p_last_message_id,
+        p_message_count, p_codec, p_payload, p_raw_bytes
+    )
+    returning id into v_segment_id;
+
+    perform set_config('frejus.compacting', 'off', true);
+    return v_segment_id;
+end;
+$$;